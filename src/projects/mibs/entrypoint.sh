@@ -6,7 +6,26 @@ if [ "$1" == "test" ]; then
     export PYTHONPATH=$PYTHONPATH:/app/src
     python3 -m unittest discover
     python3 -m unittest discover -s lib/auth
+elif [ "$1" == "dispatcher" ]; then
+    export PYTHONPATH=$PYTHONPATH:/app/src
+    cd /app/src
+    exec python3 -m services.dispatcher
 else
+    # run one dispatcher next to the web app unless dispatchers are deployed separately
+    pids=''
+    if [ "${MIBS_EMBEDDED_DISPATCHER:-true}" == "true" ]; then
+        (cd /app/src && PYTHONPATH=$PYTHONPATH:/app/src exec python3 -m services.dispatcher) &
+        pids="$!"
+    fi
     uwsgi --ini /app/uwsgi.ini &
-    source /docker-entrypoint.sh
-fi
\ No newline at end of file
+    pids="$pids $!"
+    # the nginx entrypoint execs its command, so run it as a child to keep this shell as PID 1
+    # and forward the stop signal to every process, the dispatcher included
+    /docker-entrypoint.sh "$@" &
+    pids="$pids $!"
+    trap 'kill -TERM $pids 2>/dev/null' TERM INT
+    # wait returns as soon as a trapped signal arrives, so wait again for the processes to exit
+    wait
+    trap - TERM INT
+    wait
+fi
@@ -2,25 +2,35 @@
 /mibs GET POST PUT DELETE endpoints
 '''
 
-from typing import Any, Dict, List, Tuple, Union
-from flask import Blueprint, json, request, jsonify
+import base64
+import binascii
+from datetime import datetime
+from os import environ as env
+from typing import List, Optional, Tuple, Union
+from flask import Blueprint, Response, json, jsonify, request
 from flask.helpers import url_for
-from dateutil.parser import parse as datetimeParse
 from http import HTTPStatus
+import sqlalchemy
+from sqlalchemy.orm import selectinload
 
 from lib.logger.safezone_logger import get_logger
-from lib.mibs.python.openapi.swagger_server.models import MessageInABottle, EmailRecipient
-from lib.mibs.python.openapi.swagger_server.models.any_of_message_in_a_bottle_recipients_items \
-    import AnyOfMessageInABottleRecipientsItems
-from lib.mibs.python.openapi.swagger_server.models.sms_recipient import SmsRecipient
-from lib.mibs.python.openapi.swagger_server.models.user_recipient import UserRecipient
 from models import Message, EmailMessageRecipient, db
+from api.mibs_json import encode_mibs
+from api.mibs_validation import MibRequest, validate_mib
+from services.due_notifications import publish_message_due, publish_messages_due
 from auth import auth_token
 from auth_init import auth
 
-import re
 LOGGER = get_logger(__name__)
 mibs_blueprint = Blueprint('mibs', __name__, url_prefix='/mibs')
+# Number of mibs returned per page by GET /mibs when a cursor is given without a limit
+DEFAULT_PAGE_SIZE = int(env.get('MIBS_DEFAULT_PAGE_SIZE', 100))
+# Largest limit accepted by GET /mibs, larger ones are reduced to it
+MAX_PAGE_SIZE = int(env.get('MIBS_MAX_PAGE_SIZE', 1000))
+# Largest number of mibs accepted by POST /mibs/batch
+MAX_BATCH_SIZE = int(env.get('MIBS_MAX_BATCH_SIZE', 1000))
+# Rows per multi-row INSERT statement of POST /mibs/batch
+INSERT_CHUNK_SIZE = 1000
 
 @mibs_blueprint.route('', methods=['GET'])
 @auth.require_token
@@ -29,32 +39,56 @@ def get():
     /mibs GET endpoint. See openapi file.
     '''
     def serialize(mibs):
-        if len(mibs) == 0:
-            return []
-        messages = []
-        for m in mibs:
-            messages.append(MessageInABottle(message_id=m.message_id,
-                message=m.message,
-                send_time=m.send_time,
-                recipients=[EmailRecipient(email=er.email)
-                    for er in m.email_recipients]).to_dict())
-        return messages
+        return Response(encode_mibs(mibs), mimetype='application/json')
 
     def get_all_messages(user_id):
-        return jsonify(serialize(Message.query.filter_by(user_id=user_id, sent=False).all()))
+        cursor = request.args.get('cursor')
+        limit = request.args.get('limit')
+        # pagination is opt-in: clients that never follow the cursor get every mib
+        if limit is None and cursor is None:
+            mibs = Message.query.options(selectinload(Message.email_recipients)) \
+                .filter_by(user_id=user_id, sent=False) \
+                .order_by(Message.send_time, Message.message_id).all()
+            return serialize(mibs), HTTPStatus.OK
+
+        limit = str(DEFAULT_PAGE_SIZE) if limit is None else limit
+        if not limit.isdecimal() or int(limit) == 0:
+            return 'invalid limit: limit must be a positive integer', HTTPStatus.BAD_REQUEST
+        limit = min(int(limit), MAX_PAGE_SIZE)
+        after = None
+        if cursor is not None:
+            after = _decode_cursor(cursor)
+            if after is None:
+                return 'invalid cursor', HTTPStatus.BAD_REQUEST
+
+        # one more than the page tells if there is a next page
+        query = Message.query.options(selectinload(Message.email_recipients)) \
+            .filter_by(user_id=user_id, sent=False)
+        if after is not None:
+            query = query.filter(sqlalchemy.tuple_(Message.send_time, Message.message_id)
+                > sqlalchemy.tuple_(*after))
+        mibs = query.order_by(Message.send_time, Message.message_id).limit(limit + 1).all()
+
+        headers = {}
+        if len(mibs) > limit:
+            mibs = mibs[:limit]
+            next_cursor = _encode_cursor(mibs[-1].send_time, mibs[-1].message_id)
+            headers['Link'] = f'<{url_for(".get", limit=limit, cursor=next_cursor)}>; rel="next"'
+            headers['X-Next-Cursor'] = next_cursor
+        return serialize(mibs), HTTPStatus.OK, headers
 
     assert request is not None
     given_id = request.args.get('messageId')
     user_id = auth_token['sub']
     if given_id is None:
-        return get_all_messages(user_id), HTTPStatus.OK
+        return get_all_messages(user_id)
 
     if not given_id.isnumeric():
         return 'invalid messageId: messageId must be an integer', HTTPStatus.BAD_REQUEST
 
     # valid message_id is given
-    mib = Message.query.filter_by(
-        user_id=user_id, message_id=given_id).all()
+    mib = Message.query.options(selectinload(Message.email_recipients)) \
+        .filter_by(user_id=user_id, message_id=given_id).all()
 
     if len(mib) == 0:
         LOGGER.debug(f'no mib found for messages with ID, {given_id}')
@@ -62,7 +96,30 @@ def get():
     else:
         status = HTTPStatus.OK
 
-    return jsonify(serialize(mib)), status
+    return serialize(mib), status
+
+
+def _encode_cursor(send_time: datetime, message_id: int) -> str:
+    '''
+    Return the opaque GET /mibs cursor of the page following the mib with the given
+    send_time and message_id
+    '''
+    position = json.dumps([send_time.isoformat(), message_id])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Optional[Tuple[datetime, int]]:
+    '''
+    Return the (send_time, message_id) encoded in a GET /mibs cursor, or None if cursor
+    was not made by _encode_cursor
+    '''
+    try:
+        send_time, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(message_id, int):
+            return None
+        return datetime.fromisoformat(send_time), message_id
+    except (binascii.Error, ValueError, TypeError):
+        return None
 
 
 @mibs_blueprint.route('', methods=['POST'])
@@ -86,111 +143,48 @@ def _handle_post_put(is_put=False):
         see openapi file for /mibs PUT and POST endpoints
     '''
 
-    def validate() -> Tuple[bool, Tuple[str, HTTPStatus], Message]:
+    def validate() -> Tuple[bool, Tuple[str, HTTPStatus], Message, MibRequest]:
 
         if not request.is_json:
-            return False, ('Request is not JSON', HTTPStatus.BAD_REQUEST), None
-
-        body = request.get_json()
-
-        if is_put and not 'messageId' in body:
-            return False, ('"messageId" missing from request body', HTTPStatus.BAD_REQUEST), None
-
-        if is_put and not isinstance(body['messageId'], int):
-            return False, ('invalid messageId: messageId must be an integer', \
-                   HTTPStatus.BAD_REQUEST), None
-
-        if not 'message' in body:
-            return False, ('"message" missing from request body', HTTPStatus.BAD_REQUEST), None
-
-        if not 'recipients' in body:
-            return False, ('"recipients" missing from request body', HTTPStatus.BAD_REQUEST), None
-
-        if len(body['message']) == 0:
-            return False, ('message cannot be empty', HTTPStatus.BAD_REQUEST), None
-
-        def validate_email(email):
-            '''
-            Checks if an email address is valid
-
-            Preconditions:
-                email is not None
-                email is a string
-
-            Postcondition:
-                returns a boolean True if the email is valid
-                or a boolean False if the email is invalid
-            '''
-            regex = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-            if not re.fullmatch(regex, email):
-                return False
-            else:
-                return True
-
-        if len(body['recipients']) != 0:
-            if not validate_email(body['recipients'][0]['email']):
-                return False, ('invalid email in request body', HTTPStatus.BAD_REQUEST), None
-
-        email_recipients, sms_recipients, user_recipients, unknown_recipients = \
-            _parse_recipients(body['recipients'])
-
-        if len(unknown_recipients) > 0:
-            LOGGER.info('Unknown recipient types')
-            return False, (f'Unknown recipient types: {json.dumps(unknown_recipients)}', \
-                HTTPStatus.BAD_REQUEST), None
-
-        if len(email_recipients + sms_recipients + user_recipients) <= 0:
-            return False, ('Must have at least 1 recipient', HTTPStatus.BAD_REQUEST), None
+            return False, ('Request is not JSON', HTTPStatus.BAD_REQUEST), None, None
 
-        if not 'sendTime' in body:
-            return False, ('"sendTime" missing from request body', HTTPStatus.BAD_REQUEST), None
-
-        email_recipients_string_list = [str(r.email) for r in email_recipients]
-        if len(set(email_recipients_string_list)) != len(email_recipients_string_list):
-            return False, ("Can't have duplicate recipients", HTTPStatus.BAD_REQUEST), None
-        try:
-            datetimeParse(body['sendTime'])
-        except ValueError:
-            return False, ('"sendTime" is not an ISO-8601 UTC date time string', \
-                HTTPStatus.BAD_REQUEST), None
+        mib, error = validate_mib(request.get_json(), is_put)
+        if error is not None:
+            if error.startswith('Unknown recipient types'):
+                LOGGER.info('Unknown recipient types')
+            return False, (error, HTTPStatus.BAD_REQUEST), None, None
 
         message = None
         user_id = auth_token['sub']
         if is_put:
             message = Message.query \
-                .filter_by(message_id=int(body['messageId']), user_id=user_id).first()
+                .filter_by(message_id=mib.message_id, user_id=user_id).first()
             if message is None:
                 return False, \
-                    (f'a message with messageId={body["messageId"]} could not be found',
-                    HTTPStatus.BAD_REQUEST), None
+                    (f'a message with messageId={mib.message_id} could not be found',
+                    HTTPStatus.BAD_REQUEST), None, None
 
             if message.sent or message.last_sent_time is not None:
-                return False, ('message already sent', HTTPStatus.BAD_REQUEST), None
+                return False, ('message already sent', HTTPStatus.BAD_REQUEST), None, None
 
-        return True, (None, None), message
+        return True, (None, None), message, mib
 
     assert request is not None
     assert isinstance(is_put, bool)
 
-    is_valid_request, error_response, message = validate()
+    is_valid_request, error_response, message, mib = validate()
 
     if not is_valid_request:
         return error_response
 
-    # Note: the request recipients is not converted to a
-    # AnyOfMessageInABottleRecipients and is instead just a dict
-    mib = MessageInABottle.from_dict(request.get_json())
-    parsed_email_recipients, *_ = _parse_recipients(mib.recipients)
-    email_recipients = [
-        EmailMessageRecipient(email=email_recipient.email)
-        for email_recipient in parsed_email_recipients
-    ]
+    email_recipients = [EmailMessageRecipient(email=email) for email in mib.emails]
 
     if is_put:
         message.message = mib.message
         message.send_time = mib.send_time
         message.email_recipients = email_recipients
 
+        publish_message_due(message.message_id, message.send_time)
         db.session.commit()
         return 'MessageInABottle was successfully updated', HTTPStatus.OK
 
@@ -201,43 +195,109 @@ def _handle_post_put(is_put=False):
         email_recipients=email_recipients
     )
     db.session.add(message)
+    db.session.flush()
+    publish_message_due(message.message_id, message.send_time)
     db.session.commit()
 
     return 'MessageInABottle was successfully created', HTTPStatus.CREATED, \
         {'Location': url_for('.get', messageId=message.message_id)}
 
 
-def _parse_recipients(recipients: List[Union[AnyOfMessageInABottleRecipientsItems,
-        Dict[str, Any]]]) -> Tuple[EmailRecipient, SmsRecipient, UserRecipient, Dict[str, Any]]:
+@mibs_blueprint.route('/batch', methods=['POST'])
+@auth.require_token
+def post_batch():
     '''
-    Parse a list recipients in to their respective categories.
-
-    Preconditions:
-        recipients is not None
-        recipients is a list
-
-    Postconditions:
-        returns a tuple of (email_recipients, sms_recipients, user_recipients, unknown_recipients)
-            where each element of the tuple is a list of recipients corresponding to that
-            category
-        Note: sms_recipients and user_recipients will always be empty lists and their entries
-            will be in unknown_recipients since sms and user recipients are not implemented.
+    /mibs/batch POST endpoint. See openapi file.
     '''
+    assert request is not None
+    if not request.is_json:
+        return 'Request is not JSON', HTTPStatus.BAD_REQUEST
+
+    body = request.get_json()
+    if not isinstance(body, list):
+        return 'Request body must be a JSON array of MessageInABottle', HTTPStatus.BAD_REQUEST
+    if len(body) == 0:
+        return 'Must have at least 1 MessageInABottle', HTTPStatus.BAD_REQUEST
+    if len(body) > MAX_BATCH_SIZE:
+        return f'Can\'t have more than {MAX_BATCH_SIZE} MessageInABottle in a batch', \
+            HTTPStatus.BAD_REQUEST
+
+    mibs = []
+    errors = []
+    for index, item in enumerate(body):
+        mib, error = validate_mib(item)
+        if error is not None:
+            errors.append({'index': index, 'error': error})
+        else:
+            mibs.append(mib)
+    if len(errors) > 0:
+        LOGGER.info(f'Rejected a batch of {len(body)} mib(s) with {len(errors)} invalid mib(s)')
+        return jsonify(errors), HTTPStatus.BAD_REQUEST
 
-    assert recipients is not None
-    assert isinstance(recipients, List)
+    message_ids = create_mibs(auth_token['sub'], mibs)
+    db.session.commit()
+    LOGGER.debug(f'Created a batch of {len(message_ids)} mib(s)')
+    return jsonify([{'messageId': message_id, 'location': url_for('.get', messageId=message_id)}
+        for message_id in message_ids]), HTTPStatus.CREATED
 
-    email_recipients = []
-    sms_recipients = []
-    user_recipients = []
-    unknown_recipients = []
-    for recipient in recipients:
-        if 'email' in recipient:
-            email_recipients.append(EmailRecipient.from_dict(recipient))
-        else:
-            unknown_recipients.append(recipient)
 
-    return (email_recipients, sms_recipients, user_recipients, unknown_recipients)
+def create_mibs(user_id: str, mibs: List[MibRequest]) -> List[int]:
+    '''
+    Inserts messages in a bottle and their email recipients with multi-row INSERTs
+    Arguments:
+        user_id - the id of the user creating the mibs
+        mibs - the validated mibs to create
+    Preconditions:
+        user_id is a non empty string
+    Postconditions:
+        the mibs are added to the current transaction, which the caller commits, and the
+        message pooling service is notified of them when it commits
+    Returns:
+        the ids of the new messages, in the order of mibs
+    '''
+    assert isinstance(user_id, str)
+    assert user_id != ''
+    if len(mibs) == 0:
+        return []
+
+    if db.engine.dialect.name == 'postgresql':
+        # reserve the ids up front, so every row can be inserted in a multi-row INSERT
+        message_ids = [row[0] for row in db.session.execute(sqlalchemy.text(
+                'SELECT nextval(pg_get_serial_sequence(\'"Message"\', \'messageId\')) '
+                'FROM generate_series(1, :count)'),
+            {'count': len(mibs)})]
+        _insert_rows(Message.__table__, [{
+                'messageId': message_id,
+                'userId': user_id,
+                'message': mib.message,
+                'sendTime': mib.send_time,
+                'sent': False,
+            } for message_id, mib in zip(message_ids, mibs)])
+    else:
+        # ids cannot be reserved, so the messages are inserted one by one to learn them
+        messages = [Message(user_id=user_id, message=mib.message, send_time=mib.send_time)
+            for mib in mibs]
+        db.session.add_all(messages)
+        db.session.flush()
+        message_ids = [message.message_id for message in messages]
+
+    _insert_rows(EmailMessageRecipient.__table__, [{
+            'MessageId': message_id,
+            'email': email,
+            'sent': False,
+            'attemptCount': 0,
+        } for message_id, mib in zip(message_ids, mibs) for email in mib.emails])
+    publish_messages_due([(message_id, mib.send_time)
+        for message_id, mib in zip(message_ids, mibs)])
+    return message_ids
+
+
+def _insert_rows(table: sqlalchemy.Table, rows: List[dict]):
+    '''
+    Insert rows into table with one multi-row INSERT per INSERT_CHUNK_SIZE rows
+    '''
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.session.execute(table.insert().values(rows[start:start + INSERT_CHUNK_SIZE]))
 
 
 @mibs_blueprint.route('', methods=['PUT'])
@@ -0,0 +1,54 @@
+'''
+JSON encoding of GET /mibs responses, straight from the rows of the database
+
+Produces the same bytes as building a swagger MessageInABottle per row and passing their
+to_dict() to flask.jsonify with its default settings: sorted keys, compact separators,
+ASCII only strings and send_time as an HTTP date, without the reflection of the swagger models.
+'''
+from datetime import datetime, timezone
+from json.encoder import encode_basestring_ascii
+from typing import Iterable, Tuple
+from models import Message
+
+MibRow = Tuple[int, str, datetime, Iterable[str]]
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def _http_date(value: datetime) -> str:
+    '''
+    Same as werkzeug.http.http_date, which is slow for its generality: naive datetimes are UTC
+    '''
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return f'{_DAYS[value.weekday()]}, {value.day:02d} {_MONTHS[value.month - 1]} ' \
+        f'{value.year:04d} {value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT'
+
+
+def encode_mib_rows(rows: Iterable[MibRow]) -> bytes:
+    '''
+    Encode mibs given as (message_id, message, send_time, recipient emails) tuples
+
+    Preconditions:
+        every message_id is an integer, message and emails are strings and send_time
+        is a datetime
+    Postcondition:
+        returns the JSON array of the mibs, terminated by a newline like flask.jsonify
+    '''
+    mibs = []
+    for message_id, message, send_time, emails in rows:
+        recipients = ','.join(f'{{"email":{encode_basestring_ascii(email)}}}'
+            for email in emails)
+        mibs.append(f'{{"message":{encode_basestring_ascii(message)},'
+            f'"message_id":{int(message_id)},"recipients":[{recipients}],'
+            f'"send_time":"{_http_date(send_time)}"}}')
+    return f'[{",".join(mibs)}]\n'.encode('ascii')
+
+
+def encode_mibs(mibs: Iterable[Message]) -> bytes:
+    '''
+    Encode Message rows with their email recipients. See encode_mib_rows
+    '''
+    return encode_mib_rows((mib.message_id, mib.message, mib.send_time,
+            [recipient.email for recipient in mib.email_recipients])
+        for mib in mibs)
@@ -0,0 +1,90 @@
+'''
+Validation of the MessageInABottle request bodies of POST and PUT /mibs, see the openapi file
+'''
+import re
+from datetime import datetime
+from typing import Any, List, NamedTuple, Optional, Tuple
+from dateutil.parser import parse as datetimeParse
+from flask import json
+
+EMAIL_PATTERN = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+
+
+class MibRequest(NamedTuple):
+    '''
+    A valid MessageInABottle request body. message_id is None unless it is an update.
+    '''
+    message_id: Optional[int]
+    message: str
+    send_time: datetime
+    emails: List[str]
+
+
+def validate_mib(body: Any, is_put: bool = False) -> Tuple[Optional[MibRequest], Optional[str]]:
+    '''
+    Validate and parse a MessageInABottle request body in a single pass
+
+    Preconditions:
+        body is the parsed JSON of the request
+        is_put is True if body updates an existing mib, and must then have a messageId
+    Postcondition:
+        returns (mib, None) if body is valid, otherwise (None, error) where error is the
+        message of the first check body failed. sms and user recipients are not implemented
+        and are rejected as unknown recipient types.
+    '''
+    if not isinstance(body, dict):
+        return None, 'Request body must be a JSON object'
+
+    if is_put and not 'messageId' in body:
+        return None, '"messageId" missing from request body'
+
+    message_id = body.get('messageId') if is_put else None
+    if is_put and (not isinstance(message_id, int) or isinstance(message_id, bool)):
+        return None, 'invalid messageId: messageId must be an integer'
+
+    if not 'message' in body:
+        return None, '"message" missing from request body'
+
+    if not 'recipients' in body:
+        return None, '"recipients" missing from request body'
+
+    message = body['message']
+    if not isinstance(message, str):
+        return None, 'message must be a string'
+
+    if len(message) == 0:
+        return None, 'message cannot be empty'
+
+    recipients = body['recipients']
+    if not isinstance(recipients, list):
+        return None, 'recipients must be a list'
+
+    emails = []
+    unknown_recipients = []
+    for recipient in recipients:
+        if isinstance(recipient, dict) and 'email' in recipient:
+            email = recipient['email']
+            if not isinstance(email, str) or not EMAIL_PATTERN.fullmatch(email):
+                return None, 'invalid email in request body'
+            emails.append(email)
+        else:
+            unknown_recipients.append(recipient)
+
+    if len(unknown_recipients) > 0:
+        return None, f'Unknown recipient types: {json.dumps(unknown_recipients)}'
+
+    if len(emails) <= 0:
+        return None, 'Must have at least 1 recipient'
+
+    if not 'sendTime' in body:
+        return None, '"sendTime" missing from request body'
+
+    if len(set(emails)) != len(emails):
+        return None, "Can't have duplicate recipients"
+
+    try:
+        send_time = datetimeParse(body['sendTime'])
+    except (ValueError, TypeError, OverflowError):
+        return None, '"sendTime" is not an ISO-8601 UTC date time string'
+
+    return MibRequest(message_id, message, send_time, emails), None
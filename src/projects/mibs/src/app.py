@@ -3,17 +3,14 @@ Stub for MIBS system
 '''
 from flask import Flask, request
 from os import environ as env
+from config import database_uri
 from models import db, Message
+from models.schema import upgrade_schema
 from src.api.mibs import mibs_blueprint
-from services.message_pool_service import MessagePoolingService
 from auth_init import auth
 
-db_addr = env.get('DB_ADDR')
-db_name = env.get('DB_DATABASE')
-db_user = env.get('DB_USER')
-db_pass = env.get('DB_PASSWORD')
 auth_issuer = env.get('AUTH_ISSUER')
-db_uri = f'postgresql+psycopg2://{db_user}:{db_pass}@{db_addr}/{db_name}'
+db_uri = database_uri()
 
 app = Flask(__name__)
 app.config.update({
@@ -28,9 +25,9 @@ app.config.update({
 auth.init_app(app)
 
 db.init_app(app)
+# messages are dispatched by a separate process, see services/dispatcher.py
 with app.app_context():
-    db.create_all()
-    MessagePoolingService().start()
+    upgrade_schema()
 
 @app.route('/mibs/hello',methods=['POST','GET'])
 @auth.require_token
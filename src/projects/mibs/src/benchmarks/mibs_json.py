@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of the GET /mibs JSON encoding, comparing api.mibs_json to the swagger models
+and flask.jsonify it replaced:
+
+    cd src && python3 -m benchmarks.mibs_json [--mibs N] [--recipients N] [--repeat N]
+"""
+import argparse
+import functools
+import timeit
+from datetime import datetime, timedelta
+from flask import Flask, jsonify
+from lib.mibs.python.openapi.swagger_server.models import MessageInABottle, EmailRecipient
+from api.mibs_json import encode_mibs
+from models import Message, EmailMessageRecipient
+
+
+def swagger_json(mibs) -> bytes:
+    '''
+    Encode mibs the way GET /mibs did before api.mibs_json, in an app context
+    '''
+    return jsonify([MessageInABottle(message_id=m.message_id,
+            message=m.message,
+            send_time=m.send_time,
+            recipients=[EmailRecipient(email=er.email) for er in m.email_recipients]).to_dict()
+        for m in mibs]).get_data()
+
+
+def main():
+    '''
+    Time both encodings of a page of generated mibs and print the time per page
+    '''
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mibs', type=int, default=100, help='mibs per page')
+    parser.add_argument('--recipients', type=int, default=3, help='recipients per mib')
+    parser.add_argument('--repeat', type=int, default=200, help='pages encoded per timing')
+    args = parser.parse_args()
+
+    now = datetime(2021, 10, 27, 23, 22, 19)
+    mibs = [Message(message_id=i, message=f'Message in a bottle number {i}',
+            send_time=now + timedelta(minutes=i),
+            email_recipients=[EmailMessageRecipient(email=f'recipient{j}.{i}@email.com')
+                for j in range(args.recipients)])
+        for i in range(1, args.mibs + 1)]
+
+    with Flask(__name__).app_context():
+        assert encode_mibs(mibs) == swagger_json(mibs)
+        results = {}
+        for name, encode in [('swagger + jsonify', swagger_json), ('mibs_json', encode_mibs)]:
+            seconds = min(timeit.repeat(functools.partial(encode, mibs), number=args.repeat,
+                repeat=5))
+            results[name] = seconds / args.repeat
+            print(f'{name:>20}: {results[name] * 1e3:8.3f} ms per page of {args.mibs} mibs')
+    print(f'{"speedup":>20}: {results["swagger + jsonify"] / results["mibs_json"]:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Configuration shared by the MIBS web app and the standalone dispatcher
+"""
+from os import environ as env
+from flask import Flask
+from models import db
+
+
+def database_uri() -> str:
+    '''
+    Return the SQLAlchemy URI of the MIBS database from the DB_* environment variables
+    '''
+    db_addr = env.get('DB_ADDR')
+    db_name = env.get('DB_DATABASE')
+    db_user = env.get('DB_USER')
+    db_pass = env.get('DB_PASSWORD')
+    return f'postgresql+psycopg2://{db_user}:{db_pass}@{db_addr}/{db_name}'
+
+
+def create_dispatcher_app() -> Flask:
+    '''
+    Create a bare Flask app holding the database configuration of the dispatcher and of its
+    command line tools
+    '''
+    app = Flask(__name__)
+    app.config.update({
+        'SQLALCHEMY_DATABASE_URI': database_uri(),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        # send the per-row UPDATEs of a batch of delivery results in pages of statements
+        # rather than one round trip per recipient
+        'SQLALCHEMY_ENGINE_OPTIONS': {'executemany_mode': 'values_plus_batch'},
+    })
+    db.init_app(app)
+    return app
@@ -9,12 +9,20 @@ db = SQLAlchemy()
 class Message(db.Model):
     '''Database model representing a message in a bottle.'''
     __tablename__ = "Message"
+    __table_args__ = (
+        db.Index("ix_Message_sent_sendTime", "sent", "sendTime"),
+        # keyset pagination of the unsent messages of a user, see GET /mibs
+        db.Index("ix_Message_userId_sent_sendTime_messageId",
+            "userId", "sent", "sendTime", "messageId"),
+    )
     message_id = db.Column("messageId", db.Integer, primary_key=True)
     user_id = db.Column("userId", db.Unicode, nullable=False)
     message = db.Column("message", db.UnicodeText, nullable=False)
     send_time = db.Column("sendTime", db.DateTime, nullable=False)
     sent = db.Column("sent", db.Boolean, nullable=False, default=False)
     last_sent_time = db.Column("lastSentTime", db.DateTime, default=None)
+    claimed_by = db.Column("claimedBy", db.Unicode, default=None)
+    lease_expires_at = db.Column("leaseExpiresAt", db.DateTime, default=None)
     email_recipients = db.relationship("EmailMessageRecipient",
         backref="message",
         cascade="all,delete,delete-orphan",
@@ -24,10 +32,28 @@ class Message(db.Model):
 class EmailMessageRecipient(db.Model):
     '''Database model for a recipient of a message in a bottle via email.'''
     __tablename__ = "EmailMessageRecipient"
+    __table_args__ = (
+        db.Index("ix_EmailMessageRecipient_sent_nextAttemptAt", "sent", "nextAttemptAt"),
+    )
     message_send_request_id = db.Column("messageSendRequestId",
         db.Integer, primary_key=True)
     message_id = db.Column("MessageId", db.Integer,
-        db.ForeignKey("Message.messageId", ondelete="CASCADE"), nullable=False)
+        db.ForeignKey("Message.messageId", ondelete="CASCADE"), nullable=False, index=True)
     email = db.Column("email", db.Unicode, nullable=False)
     sent = db.Column("sent", db.Boolean, nullable=False, default=False)
     send_attempt_time = db.Column("sendAttemptTime", db.DateTime, default=None)
+    attempt_count = db.Column("attemptCount", db.Integer, nullable=False, default=0)
+    # None until the first failed attempt: the recipient is then due at the send time
+    next_attempt_at = db.Column("nextAttemptAt", db.DateTime, default=None)
+
+class DeadLetterRecipient(db.Model):
+    '''Database model for an email recipient that could not be sent and is no longer retried.'''
+    __tablename__ = "DeadLetterRecipient"
+    dead_letter_id = db.Column("deadLetterId", db.Integer, primary_key=True)
+    message_id = db.Column("MessageId", db.Integer,
+        db.ForeignKey("Message.messageId", ondelete="CASCADE"), nullable=False, index=True)
+    email = db.Column("email", db.Unicode, nullable=False)
+    attempt_count = db.Column("attemptCount", db.Integer, nullable=False)
+    smtp_code = db.Column("smtpCode", db.Integer, default=None)
+    last_error = db.Column("lastError", db.UnicodeText, default=None)
+    dead_lettered_at = db.Column("deadLetteredAt", db.DateTime, nullable=False)
@@ -0,0 +1,64 @@
+"""
+Brings the MIBS database up to date with the models at startup. db.create_all() only creates the
+missing tables, with their indexes, so the columns and indexes added to existing tables are added
+here. Every step is idempotent. On Postgres the upgrade holds an advisory lock, so the web app and
+the dispatchers starting at once upgrade the database one after the other.
+"""
+from os import environ as env
+import sqlalchemy
+from models import db
+from lib.logger.safezone_logger import get_logger
+
+LOGGER = get_logger(__name__)
+# Postgres advisory lock key held for the duration of a schema upgrade
+SCHEMA_LOCK_KEY = int(env.get('MIBS_SCHEMA_LOCK_KEY', 0x4d494254))
+
+# (table, column, column DDL) of the columns added to tables of earlier releases
+ADDED_COLUMNS = [
+    ('Message', 'claimedBy', 'VARCHAR'),
+    ('Message', 'leaseExpiresAt', 'TIMESTAMP'),
+    ('EmailMessageRecipient', 'attemptCount', 'INTEGER NOT NULL DEFAULT 0'),
+    ('EmailMessageRecipient', 'nextAttemptAt', 'TIMESTAMP'),
+]
+
+
+def upgrade_schema():
+    '''
+    Create the missing tables, and add the missing columns and indexes of the models, in a
+    single transaction
+
+    Preconditions:
+        called in an app context
+    Postcondition:
+        the database has every table, column and index of the models
+    '''
+    with db.engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # released when the transaction ends, once the upgrade is committed
+            connection.execute(sqlalchemy.text('SELECT pg_advisory_xact_lock(:key)'),
+                {'key': SCHEMA_LOCK_KEY})
+        db.metadata.create_all(bind=connection)
+        for table, column, ddl in ADDED_COLUMNS:
+            _add_column(connection, table, column, ddl)
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                _create_index(connection, index)
+
+
+def _add_column(connection, table: str, column: str, ddl: str):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(sqlalchemy.text(
+            f'ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS "{column}" {ddl}'))
+        return
+    # other databases have no ADD COLUMN IF NOT EXISTS
+    existing = {existing_column['name']
+        for existing_column in sqlalchemy.inspect(connection).get_columns(table)}
+    if column not in existing:
+        LOGGER.info(f'Adding column {column} to {table}')
+        connection.execute(sqlalchemy.text(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {ddl}'))
+
+
+def _create_index(connection, index: sqlalchemy.Index):
+    columns = ', '.join(f'"{column.name}"' for column in index.columns)
+    connection.execute(sqlalchemy.text(
+        f'CREATE INDEX IF NOT EXISTS "{index.name}" ON "{index.table.name}" ({columns})'))
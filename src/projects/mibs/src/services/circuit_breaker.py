@@ -0,0 +1,130 @@
+"""
+Circuit breaker around the SMTP transport. After a number of consecutive connection failures the
+circuit opens: sends fail fast and the dispatcher stops claiming messages. Once the reset timeout
+has elapsed a single probe send is let through; the circuit closes if it reaches the relay and
+opens again otherwise.
+"""
+import smtplib
+import threading
+import time
+from os import environ as env
+from typing import Callable
+from lib.logger.safezone_logger import get_logger
+from services.metrics import METRICS, Metrics
+
+LOGGER = get_logger(__name__)
+# Consecutive connection failures that open the circuit
+CIRCUIT_FAILURE_THRESHOLD = int(env.get('MIBS_SMTP_CIRCUIT_FAILURE_THRESHOLD', 5))
+# Seconds the circuit stays open before a probe send is attempted
+CIRCUIT_RESET_TIMEOUT = float(env.get('MIBS_SMTP_CIRCUIT_RESET_TIMEOUT', 30.0))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+_STATE_GAUGE = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    '''
+    Raised instead of sending while the circuit is open. retry_after is the number of
+    seconds until the next probe.
+    '''
+    def __init__(self, retry_after: float):
+        super().__init__(f'SMTP circuit is open, retry in {retry_after:.1f}s')
+        self.retry_after = retry_after
+
+
+def is_connection_failure(error: BaseException) -> bool:
+    '''
+    Return True if error means the relay could not be reached or dropped the connection,
+    as opposed to the relay replying with an error
+    '''
+    if isinstance(error, (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected)):
+        return True
+    # SMTPException derives from OSError, but its other subclasses are replies of the relay
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class CircuitBreaker:
+    '''
+    Thread safe circuit breaker counting consecutive connection failures
+    '''
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+            clock: Callable[[], float] = time.monotonic, metrics: Metrics = METRICS):
+        assert failure_threshold > 0
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._set_state(CLOSED)
+
+    @property
+    def state(self) -> str:
+        ''' CLOSED, OPEN or HALF_OPEN once the reset timeout has elapsed '''
+        with self._lock:
+            return self._current_state()
+
+    def seconds_until_probe(self) -> float:
+        ''' Return the number of seconds until sends are let through again, 0 if they are '''
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0.0
+            return max(self._opened_at + self._reset_timeout - self._clock(), 0.0)
+
+    def before_send(self):
+        '''
+        Call before every send
+
+        Postcondition:
+            raises CircuitOpenError if the circuit is open, or if it is half open and the
+            probe send is already running
+        '''
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                LOGGER.info('Probing the SMTP relay')
+                self._probing = True
+                return
+            retry_after = self._reset_timeout
+            if state == OPEN:
+                retry_after = max(self._opened_at + self._reset_timeout - self._clock(), 0.0)
+        raise CircuitOpenError(retry_after)
+
+    def record_success(self):
+        ''' Call after a send that reached the relay, even if the relay refused it '''
+        with self._lock:
+            if self._state != CLOSED:
+                LOGGER.info('SMTP relay reachable again, closing the circuit')
+            self._failures = 0
+            self._probing = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        ''' Call after a send that could not reach the relay '''
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._state == CLOSED
+                    and self._failures >= self._failure_threshold):
+                LOGGER.warning(f'SMTP relay unreachable after {self._failures} attempt(s), \
+                    opening the circuit for {self._reset_timeout}s')
+                self._metrics.increment('mibs_smtp_circuit_trips_total')
+                self._opened_at = self._clock()
+                self._probing = False
+                self._set_state(OPEN)
+
+    def _current_state(self) -> str:
+        ''' Caller must hold the lock '''
+        if self._state == OPEN and self._clock() >= self._opened_at + self._reset_timeout:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: str):
+        self._state = state
+        self._metrics.set_gauge('mibs_smtp_circuit_state', _STATE_GAUGE[state])
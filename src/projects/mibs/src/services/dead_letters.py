@@ -0,0 +1,135 @@
+"""
+Dead letters: email recipients that failed permanently or too many times. They are moved out of
+EmailMessageRecipient so they no longer weigh on the claim and due queries, and can be replayed
+in bulk once the cause is fixed:
+
+    python -m services.dead_letters [--message-id ID ...] [--batch-size N]
+"""
+import argparse
+from datetime import datetime
+from os import environ as env
+from typing import Iterable, List, Tuple
+from config import create_dispatcher_app
+from models import DeadLetterRecipient, EmailMessageRecipient, Message, db
+from models.schema import upgrade_schema
+from lib.logger.safezone_logger import get_logger
+from services.delivery_engine import DeliveryResult
+from services.due_notifications import publish_message_due
+
+LOGGER = get_logger(__name__)
+# Number of dead letters replayed per transaction
+DEAD_LETTER_REPLAY_BATCH_SIZE = int(env.get('MIBS_DEAD_LETTER_REPLAY_BATCH_SIZE', 500))
+
+
+def dead_letter_recipients(failures: Iterable[Tuple[DeliveryResult, int]], now: datetime):
+    '''
+    Move failed recipients to the dead letters in the current session. The caller commits.
+
+    Preconditions:
+        failures are (result, attempt_count) of failed deliveries, where attempt_count
+        includes the failed attempt
+        now is a naive UTC datetime
+    Postcondition:
+        every recipient in failures is deleted from EmailMessageRecipient and a
+        DeadLetterRecipient with its last error is added, unless its message was deleted
+        while it was being sent
+    '''
+    failures = list(failures)
+    if len(failures) == 0:
+        return
+    # the key share lock keeps the messages from being deleted until the caller commits
+    existing_ids = {row[0] for row in db.session.query(Message.message_id)
+        .filter(Message.message_id.in_({result.message_id for result, _ in failures}))
+        .with_for_update(key_share=True)}
+    deleted = [result for result, _ in failures if result.message_id not in existing_ids]
+    if len(deleted) > 0:
+        LOGGER.info(f'Not dead lettering {len(deleted)} recipient(s) of deleted messages')
+        failures = [failure for failure in failures if failure[0].message_id in existing_ids]
+        if len(failures) == 0:
+            return
+    LOGGER.info(f'Dead lettering {len(failures)} recipient(s)')
+    db.session.bulk_insert_mappings(DeadLetterRecipient, [{
+            'message_id': result.message_id,
+            'email': result.email,
+            'attempt_count': attempt_count,
+            'smtp_code': result.smtp_code,
+            'last_error': None if result.error is None else str(result.error),
+            'dead_lettered_at': now,
+        } for result, attempt_count in failures])
+    EmailMessageRecipient.query \
+        .filter(EmailMessageRecipient.message_send_request_id.in_(
+            [result.message_send_request_id for result, _ in failures])) \
+        .delete(synchronize_session=False)
+
+
+def replay_dead_letters(message_ids: List[int] = None,
+        batch_size: int = DEAD_LETTER_REPLAY_BATCH_SIZE) -> int:
+    '''
+    Move dead letters back to EmailMessageRecipient as never attempted recipients, one
+    transaction per batch of batch_size dead letters
+
+    Preconditions:
+        batch_size is a positive integer
+    Postcondition:
+        the dead letters of the given messages, or all of them if message_ids is None, are
+        replayed: their messages are unsent again and announced as due.
+        Returns the number of replayed dead letters.
+    '''
+    assert isinstance(batch_size, int) and batch_size > 0
+    replayed = 0
+    while True:
+        query = db.session.query(DeadLetterRecipient.dead_letter_id,
+                DeadLetterRecipient.message_id, DeadLetterRecipient.email)
+        if message_ids is not None:
+            query = query.filter(DeadLetterRecipient.message_id.in_(message_ids))
+        dead_letters = query \
+            .order_by(DeadLetterRecipient.dead_letter_id) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True) \
+            .all()
+        if len(dead_letters) == 0:
+            db.session.commit()
+            return replayed
+
+        db.session.bulk_insert_mappings(EmailMessageRecipient, [{
+                'message_id': message_id,
+                'email': email,
+            } for _, message_id, email in dead_letters])
+        DeadLetterRecipient.query \
+            .filter(DeadLetterRecipient.dead_letter_id.in_(
+                [dead_letter_id for dead_letter_id, _, _ in dead_letters])) \
+            .delete(synchronize_session=False)
+        replayed_message_ids = {message_id for _, message_id, _ in dead_letters}
+        Message.query \
+            .filter(Message.message_id.in_(replayed_message_ids)) \
+            .update({Message.sent: False}, synchronize_session=False)
+        for message_id, send_time in db.session.query(Message.message_id, Message.send_time) \
+                .filter(Message.message_id.in_(replayed_message_ids)):
+            publish_message_due(message_id, send_time)
+        db.session.commit()
+
+        replayed += len(dead_letters)
+        LOGGER.info(f'Replayed {replayed} dead letter(s)')
+        if len(dead_letters) < batch_size:
+            return replayed
+
+
+def main(argv: List[str] = None):
+    '''
+    Replay dead letters from the command line
+    '''
+    parser = argparse.ArgumentParser(description='Replay dead lettered email recipients')
+    parser.add_argument('--message-id', type=int, action='append', dest='message_ids',
+        help='only replay the dead letters of this message, can be repeated')
+    parser.add_argument('--batch-size', type=int, default=DEAD_LETTER_REPLAY_BATCH_SIZE,
+        help='number of dead letters replayed per transaction')
+    args = parser.parse_args(argv)
+
+    with create_dispatcher_app().app_context():
+        upgrade_schema()
+        replayed = replay_dead_letters(args.message_ids, args.batch_size)
+    print(f'Replayed {replayed} dead letter(s)')
+
+
+if __name__ == '__main__':
+    main()
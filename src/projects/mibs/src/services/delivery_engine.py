@@ -0,0 +1,253 @@
+"""
+Delivery engine responsible for sending the recipients of many messages concurrently, with a
+global and a per recipient domain concurrency limit
+"""
+import smtplib
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from os import environ as env
+from typing import Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from lib.logger.safezone_logger import get_logger
+from services.rate_limiter import RateLimiter
+
+LOGGER = get_logger(__name__)
+# Maximum number of SMTP transactions running at once
+DELIVERY_CONCURRENCY = int(env.get('MIBS_DELIVERY_CONCURRENCY', 16))
+# Maximum number of SMTP transactions with a recipient of a single domain running at once
+DOMAIN_CONCURRENCY = int(env.get('MIBS_DOMAIN_CONCURRENCY', 4))
+# Maximum number of recipients of a message sent in one SMTP transaction. 1 disables batching
+RECIPIENTS_PER_TRANSACTION = int(env.get('MIBS_SMTP_RECIPIENTS_PER_TRANSACTION', 50))
+# How often the caller's heartbeat is called while waiting on deliveries, in seconds
+HEARTBEAT_POLL_INTERVAL = 1.0
+
+
+class DeliveryJob(NamedTuple):
+    '''
+    A message and the recipients it must be delivered to. A recipient has the
+    message_send_request_id and email of an EmailMessageRecipient. user_id is the owner of
+    the message, whose transactions are interleaved with those of other users.
+    '''
+    message_id: int
+    message: str
+    recipients: list
+    user_id: Optional[str] = None
+
+
+class DeliveryResult(NamedTuple):
+    '''
+    The outcome of delivering a message to one recipient. smtp_code is the reply code the
+    server gave for the recipient when it rejected it. retry_after is set instead when the
+    recipient was not attempted, because of the rate limits or because the send function
+    raised an error with a retry_after, to the number of seconds after which it can be.
+    '''
+    message_id: int
+    message_send_request_id: int
+    email: str
+    sent: bool
+    error: Optional[Exception] = None
+    smtp_code: Optional[int] = None
+    retry_after: Optional[float] = None
+
+
+# send(message_id, message, emails) delivers one email to every address in emails in a
+# single transaction. It returns {email: (code, response)} for the addresses the server
+# refused, like smtplib.SMTP.sendmail, and raises when no address was accepted.
+SendFunction = Callable[[int, str, List[str]], Dict[str, Tuple[int, bytes]]]
+
+
+def email_domain(email: str) -> str:
+    '''
+    Return the lower cased domain of an email address
+    '''
+    return email.rpartition('@')[2].lower()
+
+
+class DeliveryEngine:
+    '''
+    Runs SMTP transactions on a bounded thread pool. The recipients of a message are sent in
+    transactions of up to recipients_per_transaction addresses, whatever their domains, since
+    every email goes through the same relay. A transaction counts against every domain of
+    its recipients: it is queued while one of them has domain_concurrency transactions
+    running, without blocking a pool thread.
+    Recipients over the limits of rate_limiter, if given, are deferred rather than waited on.
+    '''
+    def __init__(self, send: SendFunction, concurrency: int = DELIVERY_CONCURRENCY,
+            domain_concurrency: int = DOMAIN_CONCURRENCY,
+            recipients_per_transaction: int = RECIPIENTS_PER_TRANSACTION,
+            rate_limiter: RateLimiter = None):
+        assert concurrency > 0
+        assert domain_concurrency > 0
+        assert recipients_per_transaction > 0
+        self._send = send
+        self._rate_limiter = rate_limiter
+        self._drain_deadline: Optional[float] = None
+        self._domain_concurrency = domain_concurrency
+        self._recipients_per_transaction = recipients_per_transaction
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+            thread_name_prefix='mibs-delivery')
+
+    def deliver(self, jobs: Iterable[DeliveryJob],
+            heartbeat: Callable[[], None] = None) -> List[DeliveryResult]:
+        '''
+        Deliver every recipient of every job and gather the results
+
+        Preconditions:
+            jobs is not None
+        Postcondition:
+            returns one DeliveryResult per recipient, except the recipients of transactions
+            still running at the drain deadline. heartbeat, if given, is called at least
+            every HEARTBEAT_POLL_INTERVAL seconds while deliveries are running.
+        '''
+        assert jobs is not None
+        transactions_by_user: Dict[Optional[str], Deque[Tuple[int, str, list]]] = \
+            defaultdict(deque)
+        for job in jobs:
+            for i in range(0, len(job.recipients), self._recipients_per_transaction):
+                transactions_by_user[job.user_id].append((job.message_id, job.message,
+                    job.recipients[i:i + self._recipients_per_transaction]))
+        pending = self._interleave_users(transactions_by_user)
+
+        results = []
+        in_flight: Dict[Future, Set[str]] = {}
+        running: Dict[str, int] = defaultdict(int)
+        self._submit_pending(pending, running, in_flight, results)
+
+        while in_flight:
+            timeout = HEARTBEAT_POLL_INTERVAL
+            if self._drain_deadline is not None:
+                timeout = min(timeout, self._drain_deadline - time.monotonic())
+                if timeout <= 0:
+                    LOGGER.warning(f'Abandoning {len(in_flight)} running SMTP \
+                        transaction(s) at the drain deadline')
+                    for future in in_flight:
+                        future.cancel()
+                    while pending:
+                        message_id, _, recipients = pending.popleft()
+                        results.extend(self._deferred(message_id, recipients, 0.0))
+                    break
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            if heartbeat is not None:
+                heartbeat()
+            for future in done:
+                for domain in in_flight.pop(future):
+                    running[domain] -= 1
+                results.extend(future.result())
+            if done:
+                self._submit_pending(pending, running, in_flight, results)
+        return results
+
+    def drain(self, deadline: float):
+        '''
+        Stop starting transactions, deferring their recipients instead, and stop waiting on
+        running transactions at deadline, a time.monotonic() value
+        '''
+        self._drain_deadline = deadline
+
+    def shutdown(self):
+        ''' Wait for running sends and stop the thread pool '''
+        self._executor.shutdown(wait=True)
+
+    def _interleave_users(self, transactions_by_user: Dict[Optional[str], Deque[tuple]]) \
+            -> Deque[tuple]:
+        '''
+        Order the transactions of every user by deficit round robin on their number of
+        recipients, so that each user gets an equal share of recipients sent, however large
+        the fan-out of the others
+        '''
+        ordered = deque()
+        deficits = {user_id: 0 for user_id in transactions_by_user}
+        while transactions_by_user:
+            for user_id in list(transactions_by_user):
+                transactions = transactions_by_user[user_id]
+                deficits[user_id] += self._recipients_per_transaction
+                while transactions and len(transactions[0][2]) <= deficits[user_id]:
+                    deficits[user_id] -= len(transactions[0][2])
+                    ordered.append(transactions.popleft())
+                if not transactions:
+                    del transactions_by_user[user_id]
+        return ordered
+
+    def _submit_pending(self, pending, running, in_flight, results):
+        '''
+        Submit the queued transactions whose recipient domains are all under their
+        concurrency limit, in order, and keep the others queued. The recipients over the rate
+        limits of their domain, or all of them once draining, are added to results as
+        deferred instead.
+        '''
+        blocked = deque()
+        while pending:
+            message_id, message, recipients = pending.popleft()
+            if self._drain_deadline is not None:
+                # left for the next worker to send right away
+                results.extend(self._deferred(message_id, recipients, 0.0))
+                continue
+            recipients_by_domain = defaultdict(list)
+            for recipient in recipients:
+                recipients_by_domain[email_domain(recipient.email)].append(recipient)
+            if any(running[domain] >= self._domain_concurrency
+                    for domain in recipients_by_domain):
+                blocked.append((message_id, message, recipients))
+                continue
+            if self._rate_limiter is not None:
+                for domain in list(recipients_by_domain):
+                    domain_recipients = recipients_by_domain[domain]
+                    granted, retry_after = self._rate_limiter.acquire(domain,
+                        len(domain_recipients))
+                    results.extend(self._deferred(message_id, domain_recipients[granted:],
+                        retry_after))
+                    if granted > 0:
+                        recipients_by_domain[domain] = domain_recipients[:granted]
+                    else:
+                        del recipients_by_domain[domain]
+                recipients = [recipient for domain_recipients in recipients_by_domain.values()
+                    for recipient in domain_recipients]
+                if not recipients:
+                    continue
+            future = self._executor.submit(self._deliver_transaction, message_id, message,
+                recipients)
+            in_flight[future] = set(recipients_by_domain)
+            for domain in recipients_by_domain:
+                running[domain] += 1
+        pending.extend(blocked)
+
+    @staticmethod
+    def _deferred(message_id, recipients, retry_after: float) -> List[DeliveryResult]:
+        ''' Return the results of recipients that were not attempted '''
+        return [DeliveryResult(message_id, recipient.message_send_request_id, recipient.email,
+                False, retry_after=retry_after)
+            for recipient in recipients]
+
+    def _deliver_transaction(self, message_id, message, recipients) -> List[DeliveryResult]:
+        '''
+        Send message to recipients in one transaction and return a result per recipient
+        '''
+        try:
+            refused = self._send(message_id, message,
+                [recipient.email for recipient in recipients])
+        except smtplib.SMTPRecipientsRefused as error:
+            # every recipient was refused, each with its own reply
+            refused = error.recipients
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.debug(f'Could not send message with id: {message_id} \
+                to {len(recipients)} recipient(s): {error}')
+            smtp_code = getattr(error, 'smtp_code', None)
+            retry_after = getattr(error, 'retry_after', None)
+            return [DeliveryResult(message_id, recipient.message_send_request_id,
+                    recipient.email, False, error, smtp_code, retry_after)
+                for recipient in recipients]
+
+        results = []
+        for recipient in recipients:
+            if recipient.email not in refused:
+                results.append(DeliveryResult(message_id, recipient.message_send_request_id,
+                    recipient.email, True))
+                continue
+            smtp_code, response = refused[recipient.email]
+            LOGGER.debug(f'Recipient {recipient.email} of message with id: {message_id} \
+                was refused: {smtp_code} {response}')
+            results.append(DeliveryResult(message_id, recipient.message_send_request_id,
+                recipient.email, False,
+                smtplib.SMTPRecipientsRefused({recipient.email: (smtp_code, response)}),
+                smtp_code))
+        return results
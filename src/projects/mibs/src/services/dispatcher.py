@@ -0,0 +1,30 @@
+"""
+Standalone entry point of the message dispatcher, deployed separately from the web app:
+
+    python -m services.dispatcher
+
+Only loads the models, the email transport and the logger, with its own database engine.
+"""
+from config import create_dispatcher_app
+from models.schema import upgrade_schema
+from lib.logger.safezone_logger import get_logger
+from services.message_pool_service import MessagePoolingService
+from services.metrics import start_metrics_server
+
+LOGGER = get_logger(__name__)
+
+
+def main():
+    '''
+    Run the message pooling service in the current process until it is stopped
+    '''
+    app = create_dispatcher_app()
+    with app.app_context():
+        upgrade_schema()
+        LOGGER.info('Starting message dispatcher')
+        start_metrics_server()
+        MessagePoolingService().run()
+
+
+if __name__ == '__main__':
+    main()
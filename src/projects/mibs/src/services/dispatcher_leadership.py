@@ -0,0 +1,99 @@
+"""
+Leader election for the message pooling service. Only the processes holding one of the
+MIBS_DISPATCHER_SLOTS Postgres advisory locks dispatch messages; the others stand by and take
+over a slot as soon as its holder stops.
+"""
+from os import environ as env
+from typing import Optional
+from lib.logger.safezone_logger import get_logger
+
+LOGGER = get_logger(__name__)
+# Number of pooling processes allowed to dispatch at once across the cluster
+DISPATCHER_SLOTS = int(env.get('MIBS_DISPATCHER_SLOTS', 1))
+# Advisory lock key of the first slot; slot n uses DISPATCHER_LOCK_KEY + n
+DISPATCHER_LOCK_KEY = int(env.get('MIBS_DISPATCHER_LOCK_KEY', 0x4d494253))
+# How often a standby process tries to take a slot, in seconds
+STANDBY_RETRY_INTERVAL = float(env.get('MIBS_STANDBY_RETRY_INTERVAL', 15.0))
+
+
+class DispatcherLeadership:
+    '''
+    Holds a dispatcher slot by keeping a session level advisory lock on a dedicated
+    connection. The lock is released by Postgres if the process or its connection dies.
+
+    On databases other than Postgres (SQLite in tests) there is a single process, which
+    always holds a slot.
+    '''
+    def __init__(self, engine, slots: int = DISPATCHER_SLOTS,
+            lock_key: int = DISPATCHER_LOCK_KEY):
+        assert slots > 0
+        self._engine = engine
+        self._slots = slots
+        self._lock_key = lock_key
+        self._connection = None
+        self.slot: Optional[int] = None
+
+    def _is_postgres(self) -> bool:
+        return self._engine.dialect.name == 'postgresql'
+
+    def try_acquire(self) -> bool:
+        '''
+        Try to take a free dispatcher slot
+
+        Postcondition:
+            returns True and sets slot if a slot is held, otherwise False
+        '''
+        if self.slot is not None:
+            return True
+        if not self._is_postgres():
+            self.slot = 0
+            return True
+
+        connection = self._engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                for slot in range(self._slots):
+                    cursor.execute('SELECT pg_try_advisory_lock(%s)', (self._lock_key + slot,))
+                    if cursor.fetchone()[0]:
+                        self._connection = connection
+                        self.slot = slot
+                        LOGGER.info(f'Holding dispatcher slot {slot}')
+                        return True
+        except Exception: # pylint: disable=broad-except
+            LOGGER.exception('Could not try the dispatcher slots')
+        connection.invalidate()
+        return False
+
+    def is_held(self) -> bool:
+        '''
+        Return True if the slot is still held, checking that the lock connection is alive
+        '''
+        if self.slot is None:
+            return False
+        if self._connection is None:
+            return True
+        try:
+            with self._connection.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except Exception: # pylint: disable=broad-except
+            LOGGER.exception(f'Lost dispatcher slot {self.slot}')
+            self._close()
+            return False
+
+    def release(self):
+        '''
+        Give up the held slot so a standby process can take it
+        '''
+        if self._connection is not None:
+            LOGGER.info(f'Releasing dispatcher slot {self.slot}')
+        self._close()
+
+    def _close(self):
+        if self._connection is not None:
+            # closing the connection releases the advisory lock
+            self._connection.invalidate()
+            self._connection = None
+        self.slot = None
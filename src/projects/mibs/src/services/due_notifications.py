@@ -0,0 +1,150 @@
+"""
+Notifications used to wake the message pooling service as soon as a message is created or
+updated. Uses Postgres LISTEN/NOTIFY, and in-process callbacks on any other database (SQLite
+in tests).
+"""
+import json
+import select
+import threading
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+import sqlalchemy
+from models import db
+from lib.logger.safezone_logger import get_logger
+
+LOGGER = get_logger(__name__)
+CHANNEL = 'mibs_message_due'
+RECONNECT_DELAY = 5.0
+
+MessageDueCallback = Callable[[int, datetime], None]
+_local_subscribers: List[MessageDueCallback] = []
+
+
+def _is_postgres(engine) -> bool:
+    return engine.dialect.name == 'postgresql'
+
+
+def _to_naive_utc(send_time: datetime) -> datetime:
+    if send_time.tzinfo is None:
+        return send_time
+    return send_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def publish_message_due(message_id: int, send_time: datetime):
+    '''
+    Announce that a message is scheduled to be sent at send_time
+
+    Preconditions:
+        message_id is the id of a flushed message
+        send_time is not None
+    Postcondition:
+        On Postgres a NOTIFY is queued on the current transaction and delivered to listeners
+        when it commits. On any other database the local subscribers are called immediately.
+    '''
+    assert message_id is not None
+    assert isinstance(send_time, datetime)
+    send_time = _to_naive_utc(send_time)
+
+    if _is_postgres(db.engine):
+        payload = json.dumps({'messageId': message_id, 'sendTime': send_time.isoformat()})
+        db.session.execute(sqlalchemy.text('SELECT pg_notify(:channel, :payload)'),
+            {'channel': CHANNEL, 'payload': payload})
+        return
+
+    for callback in list(_local_subscribers):
+        callback(message_id, send_time)
+
+
+def publish_messages_due(messages: List[Tuple[int, datetime]]):
+    '''
+    Announce that every (message_id, send_time) in messages is scheduled, with a single
+    statement on Postgres. See publish_message_due
+    '''
+    if len(messages) == 0:
+        return
+    messages = [(message_id, _to_naive_utc(send_time)) for message_id, send_time in messages]
+
+    if _is_postgres(db.engine):
+        payloads = [json.dumps({'messageId': message_id, 'sendTime': send_time.isoformat()})
+            for message_id, send_time in messages]
+        db.session.execute(sqlalchemy.text(
+                'SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) '
+                'AS payload'),
+            {'channel': CHANNEL, 'payloads': payloads})
+        return
+
+    for callback in list(_local_subscribers):
+        for message_id, send_time in messages:
+            callback(message_id, send_time)
+
+
+def subscribe_local(callback: MessageDueCallback):
+    '''
+    Register callback to be called in-process for every published message
+    '''
+    _local_subscribers.append(callback)
+
+
+def unsubscribe_local(callback: MessageDueCallback):
+    '''
+    Remove a callback registered with subscribe_local
+    '''
+    if callback in _local_subscribers:
+        _local_subscribers.remove(callback)
+
+
+class DueNotificationListener(threading.Thread):
+    '''
+    Background thread that LISTENs on CHANNEL and calls on_message_due for every notification.
+    on_reconnect is called whenever the listening connection is (re)established, since
+    notifications sent while disconnected are lost.
+    '''
+    def __init__(self, engine, on_message_due: MessageDueCallback,
+            on_reconnect: Callable[[], None]):
+        super().__init__(daemon=True)
+        assert _is_postgres(engine)
+        self._engine = engine
+        self._on_message_due = on_message_due
+        self._on_reconnect = on_reconnect
+        self._stopped = threading.Event()
+
+    def stop(self):
+        ''' Stop listening '''
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception: # pylint: disable=broad-except
+                LOGGER.exception(f'Lost connection listening on {CHANNEL}')
+                self._stopped.wait(RECONNECT_DELAY)
+
+    def _listen(self):
+        connection = self._engine.raw_connection()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            LOGGER.info(f'Listening on {CHANNEL}')
+            self._on_reconnect()
+
+            while not self._stopped.is_set():
+                if select.select([dbapi_connection], [], [], RECONNECT_DELAY) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    self._dispatch(dbapi_connection.notifies.pop(0).payload)
+        finally:
+            connection.invalidate()
+
+    def _dispatch(self, payload: str):
+        try:
+            notification = json.loads(payload)
+            message_id = int(notification['messageId'])
+            send_time = datetime.fromisoformat(notification['sendTime'])
+        except (ValueError, KeyError, TypeError):
+            LOGGER.warning(f'Ignoring malformed notification on {CHANNEL}: {payload}')
+            return
+        self._on_message_due(message_id, send_time)
@@ -0,0 +1,81 @@
+"""
+In-memory priority queue of upcoming message deadlines used by the message pooling service
+to sleep until the next message is due instead of polling the database
+"""
+import heapq
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+
+class DueQueue:
+    '''
+    Thread safe min-heap of (deadline, message_id) pairs.
+
+    A message has at most one live deadline; pushing a new deadline for a message replaces
+    the old one. Replaced entries are discarded lazily when they reach the top of the heap,
+    or all at once when they outnumber the live ones.
+    '''
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int]] = []
+        self._deadlines: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._deadlines)
+
+    def push(self, message_id: int, deadline: datetime):
+        '''
+        Schedule a message to be dispatched at deadline
+
+        Preconditions:
+            message_id is not None
+            deadline is a naive UTC datetime
+        Postcondition:
+            deadline replaces any earlier scheduled deadline for message_id
+        '''
+        assert message_id is not None
+        assert isinstance(deadline, datetime)
+        with self._lock:
+            # the rescans push the same deadlines again and again
+            if self._deadlines.get(message_id) == deadline:
+                return
+            self._deadlines[message_id] = deadline
+            heapq.heappush(self._heap, (deadline, message_id))
+            if len(self._heap) > 2 * len(self._deadlines):
+                self._heap = [(live_deadline, live_id)
+                    for live_id, live_deadline in self._deadlines.items()]
+                heapq.heapify(self._heap)
+
+    def next_deadline(self) -> Optional[datetime]:
+        '''
+        Return the earliest scheduled deadline or None if the queue is empty
+        '''
+        with self._lock:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> List[int]:
+        '''
+        Remove and return the ids of every message whose deadline is at or before now
+        '''
+        due = []
+        with self._lock:
+            self._discard_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _, message_id = heapq.heappop(self._heap)
+                del self._deadlines[message_id]
+                due.append(message_id)
+                self._discard_stale()
+        return due
+
+    def _discard_stale(self):
+        '''
+        Drop heap entries that were replaced by a later push. Caller must hold the lock.
+        '''
+        while self._heap:
+            deadline, message_id = self._heap[0]
+            if self._deadlines.get(message_id) == deadline:
+                return
+            heapq.heappop(self._heap)
@@ -1,50 +1,90 @@
 """
 Email Service responsible for sending mib messages to their respective recipients
 """
-import smtplib
-from models import EmailMessageRecipient, db
+from typing import Dict, Iterable, List, Tuple
 from lib.logger.safezone_logger import get_logger
+from services.delivery_engine import DeliveryEngine, DeliveryJob, DeliveryResult
+from services.rate_limiter import RateLimiter
+from services.circuit_breaker import CircuitBreaker, is_connection_failure
+from services.transports import Transport, create_transport
 
-SMTP_HOST_PORT = 25
-SMTP_HOST = 'smtp-dev'
 SENDER = 'cmpt371team1@gmail.com'
 LOGGER = get_logger(__name__)
 class EmailService:
     '''
     Class is responsible for formulating and sending email
     '''
-    def __init__(self):
-        self._all_mibs_sent = True
+    def __init__(self, transport: Transport = None):
+        # created on first use so the pool threads belong to the process that sends
+        self._delivery_engine = None
+        self._drain_deadline = None
+        self.transport = transport if transport is not None else create_transport()
+        self.rate_limiter = RateLimiter()
+        self.circuit_breaker = CircuitBreaker()
 
-    def send_email(self, message_id, message, recipients):
+    def send_emails(self, jobs: Iterable[DeliveryJob], heartbeat=None) -> List[DeliveryResult]:
         '''
-        get email and recipient attributes from mib object in list
-        send email sequentially and update recipient.sent column to true
+        send email concurrently to every recipient of every DeliveryJob in jobs
+        heartbeat, if given, is called while waiting to keep the message leases alive
+        returns one DeliveryResult per recipient, with retry_after set for the recipients
+        deferred by the rate limits
         '''
-        for recipient in recipients:
-            LOGGER.debug(f'messageid => {message_id}, \
-            message => {message}, recipients => {recipients}')
-            assert len(message) > 0
-            assert message_id is not None
-            recipient_email_address = recipient['email']
-            LOGGER.debug(f'Attempting to send email to {recipient_email_address}...')
-            #TODO: use some template for email body
-            email_body = f'Hello, \n{message}'
-            email_subject = 'MIBS'
-            email_content = f'Subject: {email_subject}\n\n{email_body}'
+        self.rate_limiter.reload_if_changed()
+        if self._delivery_engine is None:
+            self._delivery_engine = DeliveryEngine(self._send_transaction,
+                rate_limiter=self.rate_limiter)
+            if self._drain_deadline is not None:
+                self._delivery_engine.drain(self._drain_deadline)
+        return self._delivery_engine.deliver(jobs, heartbeat)
 
-            with smtplib.SMTP(SMTP_HOST, SMTP_HOST_PORT) as server:
-                try:
-                    server.sendmail(SENDER, recipient_email_address , email_content)
-                    recipient_obj = EmailMessageRecipient.query.filter(
-                        EmailMessageRecipient.email == recipient_email_address).first()
-                    recipient_obj.sent = True
-                    db.session.add(recipient_obj)
-                except smtplib.SMTPException:
-                    self.all_mibs_sent = False
-                    LOGGER.debug(f'Could not send message with id: {message_id} \
-                        to {recipient_email_address}')
-        db.session.commit()
-        if (self._all_mibs_sent and len(recipients) > 0):
-            return True
-        return False
+    def drain(self, deadline: float):
+        '''
+        Stop starting new sends and stop waiting on running ones at deadline, a
+        time.monotonic() value. See DeliveryEngine.drain
+        '''
+        self._drain_deadline = deadline
+        if self._delivery_engine is not None:
+            self._delivery_engine.drain(deadline)
+
+    def close_idle_connections(self):
+        ''' Close the connections the transport keeps alive for later sends '''
+        self.transport.close()
+
+    def shutdown(self):
+        ''' Wait for running sends and release the delivery threads and connections '''
+        if self._delivery_engine is not None:
+            self._delivery_engine.shutdown()
+            self._delivery_engine = None
+        self._drain_deadline = None
+        self.transport.close()
+
+    def _send_transaction(self, message_id, message,
+            recipient_email_addresses: List[str]) -> Dict[str, Tuple[int, bytes]]:
+        '''
+        Send one email to every address in recipient_email_addresses with a single
+        MAIL FROM and one RCPT TO per address
+        returns {email: (code, response)} for the addresses the server refused, and raises
+        smtplib.SMTPRecipientsRefused if all of them were refused, CircuitOpenError if the
+        relay is considered down, or another smtplib.SMTPException or OSError if the email
+        could not be sent at all
+        '''
+        assert len(message) > 0
+        assert message_id is not None
+        assert len(recipient_email_addresses) > 0
+        LOGGER.debug(f'Attempting to send email to {recipient_email_addresses}...')
+        #TODO: use some template for email body
+        email_body = f'Hello, \n{message}'
+        email_subject = 'MIBS'
+        email_content = f'Subject: {email_subject}\n\n{email_body}'
+
+        self.circuit_breaker.before_send()
+        try:
+            refused = self.transport.send(SENDER, recipient_email_addresses, email_content)
+        except Exception as error:
+            if is_connection_failure(error):
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+            raise
+        self.circuit_breaker.record_success()
+        return refused
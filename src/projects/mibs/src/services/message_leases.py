@@ -0,0 +1,170 @@
+"""
+Lease based claiming of due messages. A worker owns a claimed message until its lease expires;
+the lease is extended by heartbeats while the message is being sent, so only messages whose
+worker has actually stopped are reclaimed by other workers.
+"""
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from os import environ as env
+from typing import Iterable, List, Set, Tuple
+import sqlalchemy
+from models import EmailMessageRecipient, Message, db
+from lib.logger.safezone_logger import get_logger
+from services.retry_policy import recipient_is_due
+
+LOGGER = get_logger(__name__)
+# How long a claimed message stays owned by a worker without a heartbeat
+LEASE_DURATION = timedelta(seconds=float(env.get('MIBS_LEASE_DURATION', 60.0)))
+HEARTBEAT_INTERVAL = LEASE_DURATION / 3
+
+
+def new_worker_id() -> str:
+    '''
+    Return an id unique to the calling process
+    '''
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class MessageLeaseManager:
+    '''
+    Claims due messages for a single worker and keeps their leases alive until released
+    '''
+    def __init__(self, worker_id: str = None):
+        self.worker_id = worker_id or new_worker_id()
+        self._held: Set[int] = set()
+        self._next_heartbeat = datetime.max
+
+    @property
+    def held(self) -> Set[int]:
+        ''' Ids of the messages currently leased by this worker '''
+        return set(self._held)
+
+    def claim(self, limit: int, now: datetime,
+            criterion=None) -> List[Tuple[int, str, datetime, str]]:
+        '''
+        criteria: unsent messages that are due, have a recipient whose next attempt is due,
+        or meet criterion if given instead, and are not leased, or whose lease expired
+        Claim up to limit mibs that meet criteria by leasing them to this worker
+
+        Mibs are claimed round robin across users: the oldest due mib of every user comes
+        before the second oldest of any user, so a user with a large backlog can not delay
+        the mibs of the others.
+
+        Rows locked by another worker's claim are skipped rather than waited on, so any
+        number of workers can claim from the same backlog without claiming a mib twice.
+
+        Preconditions:
+            limit is a positive integer
+            now is a naive UTC datetime
+            criterion, if given, only holds for messages with a due recipient
+        Postcondition:
+            returns a list of (message_id, message, send_time, user_id) for the claimed mibs,
+            and the leases are committed
+        '''
+        assert isinstance(limit, int) and limit > 0
+        assert isinstance(now, datetime)
+
+        claimable = (Message.sent.is_(False),
+            Message.send_time <= now,
+            sqlalchemy.or_(Message.lease_expires_at.is_(None),
+                Message.lease_expires_at <= now))
+        if criterion is None:
+            criterion = db.session.query(EmailMessageRecipient.message_send_request_id) \
+                .filter(EmailMessageRecipient.message_id == Message.message_id,
+                    recipient_is_due(now)) \
+                .exists()
+        user_rank = sqlalchemy.func.row_number().over(partition_by=Message.user_id,
+            order_by=(Message.send_time, Message.message_id))
+        candidates = db.session.query(Message.message_id.label('message_id'),
+                user_rank.label('user_rank')) \
+            .filter(*claimable, criterion) \
+            .subquery()
+        # the claimable criteria are repeated so that rows claimed by another worker since
+        # the candidates were ranked are rechecked once locked
+        claimed_mibs = db.session.query(Message.message_id, Message.message,
+                Message.send_time, Message.user_id) \
+            .join(candidates, candidates.c.message_id == Message.message_id) \
+            .filter(*claimable) \
+            .order_by(candidates.c.user_rank, Message.send_time, Message.message_id) \
+            .limit(limit) \
+            .with_for_update(skip_locked=True, of=Message) \
+            .all()
+
+        if len(claimed_mibs) > 0:
+            claimed_ids = [mib[0] for mib in claimed_mibs]
+            Message.query \
+                .filter(Message.message_id.in_(claimed_ids)) \
+                .update({
+                        Message.claimed_by: self.worker_id,
+                        Message.lease_expires_at: now + LEASE_DURATION,
+                        Message.last_sent_time: now,
+                    }, synchronize_session=False)
+            if not self._held:
+                self._next_heartbeat = now + HEARTBEAT_INTERVAL
+            self._held.update(claimed_ids)
+        db.session.commit()
+        return claimed_mibs
+
+    def heartbeat(self, force: bool = False):
+        '''
+        Extend the lease of every held message if the heartbeat interval has elapsed
+
+        Runs in its own transaction so pending changes in the session are not committed.
+
+        Postcondition:
+            messages whose lease was taken over by another worker are no longer held
+        '''
+        now = datetime.utcnow()
+        if not self._held or (not force and now < self._next_heartbeat):
+            return
+
+        held_ids = list(self._held)
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.update(Message)
+                .where(Message.message_id.in_(held_ids),
+                    Message.claimed_by == self.worker_id)
+                .values({Message.lease_expires_at: now + LEASE_DURATION}))
+            still_held = {row[0] for row in connection.execute(
+                sqlalchemy.select(Message.message_id)
+                .where(Message.message_id.in_(held_ids),
+                    Message.claimed_by == self.worker_id))}
+
+        lost = self._held - still_held
+        if lost:
+            LOGGER.warning(f'Worker {self.worker_id} lost the lease on message(s) {lost}')
+        self._held = still_held
+        self._next_heartbeat = now + HEARTBEAT_INTERVAL
+
+    def abandon(self):
+        '''
+        Stop extending the leases of every held message, so they expire and the messages
+        can be claimed again, without writing to the database
+        '''
+        if self._held:
+            LOGGER.warning(f'Worker {self.worker_id} abandons the lease on message(s) '
+                f'{self._held}')
+        self._held = set()
+
+    def release(self, message_ids: Iterable[int], sent: bool):
+        '''
+        Give up the lease on messages in the current session. The caller commits.
+
+        Preconditions:
+            message_ids are held by this worker
+        Postcondition:
+            if sent, the messages are marked "sent", otherwise they can be claimed again
+            as soon as one of their recipients is due
+        '''
+        message_ids = [message_id for message_id in message_ids if message_id in self._held]
+        if not message_ids:
+            return
+        values = {Message.claimed_by: None, Message.lease_expires_at: None}
+        if sent:
+            values[Message.sent] = True
+        Message.query \
+            .filter(Message.message_id.in_(message_ids),
+                Message.claimed_by == self.worker_id) \
+            .update(values, synchronize_session=False)
+        self._held.difference_update(message_ids)
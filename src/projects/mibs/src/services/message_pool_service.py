@@ -2,18 +2,57 @@
 Messaging Service responsible for introspecting mibs DB and sending unsent messages to the
 email service
 """
+import signal
+import threading
 import time
 import sqlalchemy
 from multiprocessing import Process
+from os import environ as env, getpid, kill
 from datetime import timedelta, datetime
-from models import Message, EmailMessageRecipient, db
-from lib.mibs.python.openapi.swagger_server.models import MessageInABottle, EmailRecipient
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Tuple
+from models import Message, EmailMessageRecipient, DeadLetterRecipient, db
 from lib.logger.safezone_logger import get_logger
+from services.due_notifications import DueNotificationListener, subscribe_local, \
+    unsubscribe_local
+from services.dispatcher_leadership import DispatcherLeadership, STANDBY_RETRY_INTERVAL
+from services.due_queue import DueQueue
+from services.delivery_engine import DeliveryJob, DeliveryResult
 from services.email_service import EmailService
+from services.circuit_breaker import HALF_OPEN, OPEN
+from services.smtp_pool import SMTP_IDLE_TIMEOUT
+from services.message_leases import MessageLeaseManager, new_worker_id
+from services.retry_policy import next_attempt_at, recipient_is_due, should_dead_letter
+from services.dead_letters import dead_letter_recipients
+from services.metrics import METRICS
+from services.priority_lanes import CATCH_UP, LANES, CatchUpProgress, lane_limits
 
 LOGGER = get_logger(__name__)
-POLL_INTERVAL = 30.0
-MESSAGE_AGE_LIMIT = timedelta(minutes=1)
+# Safety rescan: reloads upcoming deadlines from the DB in case a notification was missed
+RESCAN_INTERVAL = timedelta(seconds=float(env.get('MIBS_RESCAN_INTERVAL', 300.0)))
+# Maximum number of upcoming deadlines held in memory between rescans
+DUE_QUEUE_PRELOAD = int(env.get('MIBS_DUE_QUEUE_PRELOAD', 1000))
+# Maximum number of messages claimed by a worker per claim round, shared by the priority lanes
+CLAIM_BATCH_SIZE = int(env.get('MIBS_CLAIM_BATCH_SIZE', 100))
+# How often the size of the catch-up backlog is measured while there is one
+CATCH_UP_REPORT_INTERVAL = timedelta(
+    seconds=float(env.get('MIBS_CATCH_UP_REPORT_INTERVAL', 30.0)))
+# Maximum number of recipients of a message sent per claim round. The others are sent in the
+# following rounds, so a large fan-out does not hold up the messages claimed with it
+RECIPIENTS_PER_ROUND = int(env.get('MIBS_RECIPIENTS_PER_ROUND', 1000))
+# Seconds given to running sends to finish once shutdown is requested. Kept under the
+# 10 seconds docker waits after SIGTERM
+SHUTDOWN_TIMEOUT = float(env.get('MIBS_SHUTDOWN_TIMEOUT', 8.0))
+
+
+class DueRecipient(NamedTuple):
+    '''
+    An email recipient loaded for a claim round
+    '''
+    message_send_request_id: int
+    message_id: int
+    email: str
+    attempt_count: int
 
 class MessagePoolingService(Process):
     '''
@@ -25,90 +64,477 @@ class MessagePoolingService(Process):
         self._email_service = EmailService()
         self._current_time = datetime.utcnow()
         self._cancelled = False
+        self._due_queue = DueQueue()
+        self._wake = threading.Event()
+        self._next_rescan = datetime.min
+        self._leases = MessageLeaseManager()
+        self._catch_up = CatchUpProgress()
+        self._next_catch_up_report = datetime.min
 
     def run(self):
-        ''' Begin thread operation '''
-        while not self._cancelled:
-            LOGGER.info('Pooling unsent messages...')
-            self._get_unsent_mibs_older_than_message_age_limit()
-            time.sleep(POLL_INTERVAL)
+        '''
+        Begin thread operation
+
+        Sleeps until the earliest known message deadline or the next safety rescan,
+        whichever comes first, and only claims messages when something is due.
+        Created and updated messages are pushed to the due queue by notifications.
+        Only processes holding a dispatcher slot do this, the others stand by.
+
+        SIGTERM and SIGINT stop the service gracefully: no more messages are claimed, the
+        running sends are given SHUTDOWN_TIMEOUT seconds to finish, and their results are
+        written before the leases are released.
+        '''
+        # the worker id must identify the forked process, not the parent
+        self._leases = MessageLeaseManager(new_worker_id())
+        self._install_signal_handlers()
+        leadership = DispatcherLeadership(db.engine)
+        try:
+            while not self._cancelled:
+                if not leadership.try_acquire():
+                    self._wake.wait(STANDBY_RETRY_INTERVAL)
+                    self._wake.clear()
+                    continue
+
+                listener = self._start_listening()
+                try:
+                    self._next_rescan = datetime.min
+                    self._schedule_loop(leadership)
+                finally:
+                    if listener is None:
+                        unsubscribe_local(self._on_message_due)
+                    else:
+                        listener.stop()
+                    leadership.release()
+        finally:
+            self._email_service.shutdown()
+            db.session.remove()
+            LOGGER.info('Message pooling service stopped')
+
+    def _schedule_loop(self, leadership: DispatcherLeadership):
+        '''
+        Claim and send messages as their deadlines are reached until cancelled or the
+        dispatcher slot is lost
+        '''
+        while not self._cancelled and leadership.is_held():
+            now = datetime.utcnow()
+            if now >= self._next_rescan:
+                self._load_upcoming_deadlines(now)
+                self._next_rescan = now + RESCAN_INTERVAL
+
+            # while the SMTP relay is down nothing is claimed until the next probe
+            if self._email_service.circuit_breaker.state != OPEN \
+                    and self._due_queue.pop_due(now):
+                LOGGER.info('Pooling unsent messages...')
+                self._dispatch_due_messages()
+                if self._cancelled:
+                    break
+                # a send may have failed or a message may still be leased by another
+                # worker, so look again once those messages become claimable
+                self._load_upcoming_deadlines(datetime.utcnow())
+
+            sleep_seconds = self._seconds_until_next_wake()
+            if sleep_seconds >= SMTP_IDLE_TIMEOUT:
+                # idle connections would expire before the next send
+                self._email_service.close_idle_connections()
+            self._wake.wait(sleep_seconds)
+            self._wake.clear()
 
     def cancel(self):
-        ''' End the thread '''
-        self._cancelled = True
+        '''
+        Stop the service gracefully. Called from the parent of a started service, signals
+        the service process, since the flag would only be set in the parent's copy.
+        '''
+        if self.pid is not None and self.pid != getpid():
+            kill(self.pid, signal.SIGTERM)
+            return
+        self._begin_shutdown()
 
-    def _get_unsent_mibs_older_than_message_age_limit(self):
+    def _install_signal_handlers(self):
+        '''
+        Drain on SIGTERM and SIGINT. Handlers can only be installed from the main thread.
+        '''
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, self._handle_shutdown_signal)
+
+    def _handle_shutdown_signal(self, signal_number, frame):
+        del frame
+        LOGGER.info(f'Received signal {signal_number}, shutting down')
+        self._begin_shutdown()
+
+    def _begin_shutdown(self):
+        '''
+        Stop claiming messages and give the running sends SHUTDOWN_TIMEOUT seconds to finish
         '''
-        criteria: unsent messages older than the specified age limit
-        Get unsent mibs that meet criteria
+        if not self._cancelled:
+            self._cancelled = True
+            self._email_service.drain(time.monotonic() + SHUTDOWN_TIMEOUT)
+        self._wake.set()
+
+    def _start_listening(self):
+        '''
+        Subscribe to message due notifications. Returns the listener thread on Postgres
+        or None when local in-process notifications are used.
+        '''
+        if db.engine.dialect.name != 'postgresql':
+            subscribe_local(self._on_message_due)
+            return None
+        listener = DueNotificationListener(db.engine, self._on_message_due, self._request_rescan)
+        listener.start()
+        return listener
+
+    def _on_message_due(self, message_id: int, send_time: datetime):
+        '''
+        Schedule a created or updated message and wake the scheduler, unless it is far
+        enough in the future to be loaded by a later rescan
+        '''
+        if send_time <= datetime.utcnow() + RESCAN_INTERVAL:
+            self._due_queue.push(message_id, send_time)
+            self._wake.set()
+
+    def _request_rescan(self):
+        '''
+        Reload deadlines from the DB on the next wake up and wake the scheduler
+        '''
+        self._next_rescan = datetime.min
+        self._wake.set()
+
+    def _seconds_until_next_wake(self) -> float:
+        '''
+        Return the number of seconds until the earliest due deadline or the next rescan.
+        Deadlines are postponed until the next probe while the SMTP circuit is open.
+        '''
+        wake_time = self._next_rescan
+        next_deadline = self._due_queue.next_deadline()
+        if next_deadline is not None:
+            next_deadline = max(next_deadline, datetime.utcnow() + timedelta(
+                seconds=self._email_service.circuit_breaker.seconds_until_probe()))
+            wake_time = min(wake_time, next_deadline)
+        return max((wake_time - datetime.utcnow()).total_seconds(), 0.0)
+
+    def _load_upcoming_deadlines(self, now: datetime):
+        '''
+        Add the deadlines of unsent messages that become claimable before the next rescan
+        to the due queue. A message is claimable once the earliest next attempt of its unsent
+        recipients is reached and it is not leased.
+
         Preconditions:
-            function is called within POOL_INTERVAL duration
+            now is a naive UTC datetime
         Postcondition:
-            send all mibs that meet criteria to email service
-            and "sent" values if they are all successfully sent
+            at most DUE_QUEUE_PRELOAD of the earliest deadlines are added to the due queue
+        '''
+        horizon = now + RESCAN_INTERVAL
+        # a recipient that was never attempted is due at the send time of its message
+        earliest_attempt = sqlalchemy.func.min(sqlalchemy.func.coalesce(
+            EmailMessageRecipient.next_attempt_at, Message.send_time))
+        upcoming = db.session.query(Message.message_id, earliest_attempt,
+                Message.lease_expires_at) \
+            .join(EmailMessageRecipient,
+                EmailMessageRecipient.message_id == Message.message_id) \
+            .filter(Message.sent.is_(False), Message.send_time <= horizon,
+                EmailMessageRecipient.sent.is_(False)) \
+            .group_by(Message.message_id, Message.lease_expires_at) \
+            .having(earliest_attempt <= horizon) \
+            .order_by(earliest_attempt) \
+            .limit(DUE_QUEUE_PRELOAD) \
+            .all()
+        db.session.commit()
+
+        scheduled = 0
+        for message_id, attempt_time, lease_expires_at in upcoming:
+            deadline = attempt_time
+            if lease_expires_at is not None:
+                deadline = max(attempt_time, lease_expires_at)
+            if deadline <= horizon:
+                self._due_queue.push(message_id, deadline)
+                scheduled += 1
+        LOGGER.debug(f'{scheduled} message deadline(s) scheduled before {horizon}')
+
+    def _dispatch_due_messages(self):
+        '''
+        Claim due messages in rounds of CLAIM_BATCH_SIZE shared by the priority lanes and
+        send them until no due message is left or the SMTP circuit opens
+
+        Preconditions:
+            function is called when a deadline in the due queue is reached
+        Postcondition:
+            the due recipients of every claimed mib are sent to the email service, failed
+            recipients are scheduled for a later attempt or dead lettered, and mibs with no unsent
+            recipient and no dead letter left are marked "sent"
+        '''
+        while not self._cancelled:
+            circuit_state = self._email_service.circuit_breaker.state
+            if circuit_state == OPEN:
+                LOGGER.info('SMTP relay is down, not claiming messages')
+                return
+            # a half open circuit only lets a probe through, so claim a single message
+            capacity = 1 if circuit_state == HALF_OPEN else CLAIM_BATCH_SIZE
+            try:
+                jobs, lanes_have_more = self._claim_stage(capacity)
+                results = self._deliver_stage(jobs)
+                self._record_delivery_results(jobs, results)
+                self._report_catch_up()
+            except sqlalchemy.exc.SQLAlchemyError:
+                # a failed round must not stop the dispatcher: its mibs are claimed again
+                # once their leases expire
+                LOGGER.exception('Dispatch round failed, leaving its leases to expire')
+                db.session.rollback()
+                db.session.close()
+                self._leases.abandon()
+                return
+            if not lanes_have_more:
+                return
+
+    def _claim_stage(self, capacity: int) -> Tuple[List[DeliveryJob], bool]:
+        '''
+        First stage of a dispatch round: claim up to capacity due mibs and load their due
+        recipients, in short transactions, then return the DB connection to the pool
+
+        Postcondition:
+            returns the delivery jobs of the claimed mibs, and True if a lane may have more
+            due mibs. No transaction is left open.
+        '''
+        claimed_mibs, lanes_have_more = self._claim_lanes(capacity)
+        LOGGER.info(f'Claimed {len(claimed_mibs)} mib(s)')
+        claimed_ids = [mib[0] for mib in claimed_mibs]
+        recipients_by_message_id = self._get_email_recipients(claimed_ids, self._current_time)
+        self._update_recipients_send_attempt_time([recipient.message_send_request_id
+            for recipients in recipients_by_message_id.values() for recipient in recipients])
+        db.session.close()
+        jobs = [DeliveryJob(message_id, message, recipients_by_message_id.get(message_id, []),
+                user_id)
+            for message_id, message, _, user_id in claimed_mibs]
+        return jobs, lanes_have_more
+
+    def _deliver_stage(self, jobs: List[DeliveryJob]) -> List[DeliveryResult]:
+        '''
+        Second stage of a dispatch round: send the claimed mibs. No transaction is open
+        during the SMTP I/O, so no row stays locked and no DB connection is held; the leases
+        are kept alive by heartbeats, each in its own short transaction.
+        '''
+        assert not db.session().in_transaction()
+        return self._email_service.send_emails(jobs, heartbeat=self._leases.heartbeat)
+
+    def _claim_lanes(self, capacity: int) -> Tuple[List[Tuple[int, str, datetime, str]], bool]:
+        '''
+        Claim a round of up to capacity due mibs across the priority lanes. Every lane first
+        claims its guaranteed share, then the capacity left unused is offered to the lanes
+        in priority order, up to their batch size.
+
+        Postcondition:
+            returns the claimed mibs, and True if a lane may have more due mibs
         '''
         self._current_time = datetime.utcnow()
-        message_age_limit_in_datetime = self._current_time - MESSAGE_AGE_LIMIT
-        LOGGER.info(f'target_time => {message_age_limit_in_datetime}')
-
-        updated_mibs = db.session.execute(sqlalchemy.text(
-            'UPDATE public."Message" SET "lastSentTime" = :current_time \
-            WHERE ("lastSentTime" <= :message_age_limit OR "lastSentTime" IS NULL) \
-            AND "sent" = \'false\' AND "sendTime" <= :current_time \
-            RETURNING "messageId","message", "sendTime", "sent"'),
-            {'current_time': self._current_time, 'message_age_limit':message_age_limit_in_datetime})
-        LOGGER.info('Fetching mibs that match criteria')
-        for mib in updated_mibs:
-            mib_with_email_recipients = self._get_mib_with_email_recipients(mib)
-            if len(mib_with_email_recipients) > 0:
-                message_id = mib_with_email_recipients['message_id']
-                message = mib_with_email_recipients['message']
-                recipients = mib_with_email_recipients['recipients']
-                all_mib_emails_sent = self._email_service.send_email(
-                    message_id, message, recipients)
-                if all_mib_emails_sent is True:
-                    LOGGER.debug(f'All emails for message with id: \
-                        {message_id} have been sent sent')
-                    LOGGER.info(self._current_time)
-                    message = Message.query.get(message_id)
-                    message.sent = True
-                    db.session.add(message)
-            db.session.commit()
-
-    def _get_mib_with_email_recipients(self, mib):
-        '''
-            Populate mib object, call _update_recipients_send_attempt_time
-            and return mib object
+        claimed_mibs = []
+        claimed_by_lane = {}
+        exhausted = set()
+        for lane, limit in zip(LANES, lane_limits(LANES, capacity)):
+            lane_mibs = self._leases.claim(limit, self._current_time,
+                lane.criterion(self._current_time)) if limit > 0 else []
+            claimed_mibs += lane_mibs
+            claimed_by_lane[lane.name] = len(lane_mibs)
+            if limit > 0 and len(lane_mibs) < limit:
+                exhausted.add(lane.name)
+
+        for lane in LANES:
+            if lane.name in exhausted:
+                continue
+            extra = min(capacity - len(claimed_mibs), lane.batch_size - claimed_by_lane[lane.name])
+            if extra <= 0:
+                # a lane that claims nothing in this round would never let the dispatch end
+                if claimed_by_lane[lane.name] == 0:
+                    exhausted.add(lane.name)
+                continue
+            lane_mibs = self._leases.claim(extra, self._current_time,
+                lane.criterion(self._current_time))
+            claimed_mibs += lane_mibs
+            claimed_by_lane[lane.name] += len(lane_mibs)
+            if len(lane_mibs) < extra:
+                exhausted.add(lane.name)
+
+        for lane_name, claimed in claimed_by_lane.items():
+            if claimed > 0:
+                METRICS.increment('mibs_claimed_total', claimed, lane=lane_name)
+        return claimed_mibs, len(exhausted) < len(LANES)
+
+    def _report_catch_up(self):
+        '''
+        Measure the catch-up backlog every CATCH_UP_REPORT_INTERVAL while there is one,
+        and report its estimated time to drain
+        '''
+        now = datetime.utcnow()
+        if now < self._next_catch_up_report:
+            return
+        catch_up = next(lane for lane in LANES if lane.name == CATCH_UP)
+        backlog = db.session.query(sqlalchemy.func.count(Message.message_id)) \
+            .filter(Message.sent.is_(False), catch_up.criterion(now)) \
+            .scalar()
+        db.session.commit()
+        self._catch_up.update(backlog, now)
+        self._next_catch_up_report = now + CATCH_UP_REPORT_INTERVAL
+
+    def _record_delivery_results(self, jobs: List[DeliveryJob], results: List[DeliveryResult]):
+        '''
+        Last stage of a dispatch round: write the delivery results of a claimed batch in a
+        single commit
+
+        Preconditions:
+            jobs are the delivery jobs of mibs claimed by this worker
+            results are the delivery results of jobs
+        Postcondition:
+            successfully sent recipients are marked "sent", recipients that were not
+            attempted are scheduled after their retry_after, failed recipients are dead
+            lettered if they failed permanently or too many times, otherwise their attempt
+            count is incremented and their next attempt scheduled with backoff, the leases on
+            the mibs are released, and the mibs with no unsent recipient and no dead letter left
+            are marked "sent"
+        '''
+        attempt_counts = {recipient.message_send_request_id: recipient.attempt_count
+            for job in jobs for recipient in job.recipients}
+        now = datetime.utcnow()
+        updates = []
+        dead_letters = []
+        deferred = 0
+        for result in results:
+            if result.sent:
+                updates.append(self._recipient_update(result, True, 0, None))
+            elif result.retry_after is not None:
+                # not attempted, so it is not counted as a failure
+                deferred += 1
+                updates.append(self._recipient_update(result, False, 0,
+                    now + timedelta(seconds=result.retry_after)))
+            else:
+                attempt_count = attempt_counts[result.message_send_request_id] + 1
+                if should_dead_letter(attempt_count, result.smtp_code):
+                    dead_letters.append((result, attempt_count))
+                else:
+                    updates.append(self._recipient_update(result, False, 1,
+                        next_attempt_at(attempt_count, now)))
+        if deferred > 0:
+            LOGGER.info(f'{deferred} recipient(s) deferred')
+        dead_letter_recipients(dead_letters, now)
+        self._write_recipient_updates(updates)
+
+        # the outcome of a transaction still running at the drain deadline is unknown, so
+        # its message stays leased until the lease expires rather than be sent again now
+        result_ids = {result.message_send_request_id for result in results}
+        abandoned_ids = {job.message_id for job in jobs for recipient in job.recipients
+            if recipient.message_send_request_id not in result_ids}
+        if len(abandoned_ids) > 0:
+            LOGGER.warning(f'Leaving the leases of messages with ids: {abandoned_ids} \
+                to expire')
+
+        # recipients that were not due in this round may still be waiting for a retry
+        claimed_ids = [job.message_id for job in jobs]
+        unsent_message_ids = set()
+        failed_message_ids = set()
+        if len(claimed_ids) > 0:
+            unsent_message_ids = {row[0] for row in db.session.query(
+                    EmailMessageRecipient.message_id.distinct())
+                .filter(EmailMessageRecipient.message_id.in_(claimed_ids),
+                    EmailMessageRecipient.sent.is_(False))}
+            # a mib with dead letters was not delivered, so it stays unsent until replayed
+            failed_message_ids = {row[0] for row in db.session.query(
+                    DeadLetterRecipient.message_id.distinct())
+                .filter(DeadLetterRecipient.message_id.in_(claimed_ids))}
+        sent_message_ids = [message_id for message_id in claimed_ids
+            if message_id not in unsent_message_ids and message_id not in failed_message_ids]
+        if len(sent_message_ids) > 0:
+            LOGGER.debug(f'All emails for messages with ids: \
+                {sent_message_ids} have been sent')
+        self._leases.release(sent_message_ids, sent=True)
+        self._leases.release((unsent_message_ids | failed_message_ids) - abandoned_ids,
+            sent=False)
+        db.session.commit()
+        db.session.close()
+
+    @staticmethod
+    def _recipient_update(result: DeliveryResult, sent: bool, failed_attempts: int,
+            next_attempt: datetime) -> Dict[str, object]:
+        return {
+            'recipient_id': result.message_send_request_id,
+            'sent': sent,
+            'failed_attempts': failed_attempts,
+            'next_attempt_at': next_attempt,
+        }
+
+    @staticmethod
+    def _write_recipient_updates(updates: List[Dict[str, object]]):
+        '''
+            Write the delivery status of a batch of recipients with a single UPDATE keyed on
+            their primary key, executed for every row of updates
+            Preconditions:
+                updates are dicts with the recipient_id, sent, failed_attempts and
+                next_attempt_at of a recipient, see _recipient_update
+            Postcondition:
+                the attempt count of every recipient is incremented by its failed_attempts,
+                and its sent and next attempt time are set. The caller commits.
+        '''
+        if len(updates) == 0:
+            return
+        recipients = EmailMessageRecipient.__table__
+        db.session.execute(sqlalchemy.update(recipients)
+            .where(recipients.c.messageSendRequestId == sqlalchemy.bindparam('recipient_id'))
+            .values({
+                recipients.c.sent: sqlalchemy.bindparam('sent'),
+                recipients.c.attemptCount:
+                    recipients.c.attemptCount + sqlalchemy.bindparam('failed_attempts'),
+                recipients.c.nextAttemptAt: sqlalchemy.bindparam('next_attempt_at'),
+            }), updates)
+
+    @staticmethod
+    def _get_email_recipients(message_ids: List[int], now: datetime = None,
+            limit_per_message: int = RECIPIENTS_PER_ROUND) \
+            -> Dict[int, List[DueRecipient]]:
+        '''
+            Load the due email recipients of every given message with a single query
             Preconditions:
-                mib is not None
+                message_ids is not None
+                limit_per_message is a positive integer
             Postcondition:
-                mib object is populated and is returned
-        '''
-        assert mib is not None
-        mib_message_id = mib[0]
-        mib_message = mib[1]
-        mib_send_time = mib[2]
-        mib_recipients = EmailMessageRecipient.query.filter(
-            EmailMessageRecipient.message_id == mib_message_id)
-        self._update_recipients_send_attempt_time(mib_recipients)
-        mib = MessageInABottle(message_id=mib_message_id,
-            message=mib_message,send_time=mib_send_time,
-            recipients=[EmailRecipient(email=recipient.email)
-                for recipient in mib_recipients]).to_dict()
-        return mib
-
-    def _update_recipients_send_attempt_time(self, email_recipients):
+                returns up to limit_per_message recipients per message whose next attempt
+                is due at now, grouped by message id.
+                Plain rows are not expired by the commits of the dispatch round.
+        '''
+        assert message_ids is not None
+        assert limit_per_message > 0
+        recipients_by_message_id = defaultdict(list)
+        if len(message_ids) == 0:
+            return recipients_by_message_id
+        message_rank = sqlalchemy.func.row_number().over(
+            partition_by=EmailMessageRecipient.message_id,
+            order_by=EmailMessageRecipient.message_send_request_id)
+        due_recipients = db.session.query(EmailMessageRecipient.message_send_request_id,
+                EmailMessageRecipient.message_id, EmailMessageRecipient.email,
+                EmailMessageRecipient.attempt_count, message_rank.label('message_rank')) \
+            .filter(EmailMessageRecipient.message_id.in_(message_ids),
+                recipient_is_due(now or datetime.utcnow())) \
+            .subquery()
+        email_recipients = db.session.query(due_recipients.c.message_send_request_id,
+                due_recipients.c.message_id, due_recipients.c.email,
+                due_recipients.c.attempt_count) \
+            .filter(due_recipients.c.message_rank <= limit_per_message) \
+            .order_by(due_recipients.c.message_send_request_id) \
+            .all()
+        for recipient_id, message_id, email, attempt_count in email_recipients:
+            recipients_by_message_id[message_id].append(DueRecipient(recipient_id, message_id,
+                email, attempt_count))
+        return recipients_by_message_id
+
+    def _update_recipients_send_attempt_time(self, recipient_ids: List[int]):
         '''
             Preconditions:
-                email_recipients is not None
+                recipient_ids is not None
             Postcondition:
-                send_attempt_time is updated for all given recipients
+                send_attempt_time is updated for the given recipients with a single UPDATE
         '''
-        assert email_recipients is not None
+        assert recipient_ids is not None
+        if len(recipient_ids) == 0:
+            return
         LOGGER.info('Updating recipients send attempt time')
-        for recipient in email_recipients:
-            recipient.send_attempt_time = self._current_time
-            db.session.add(recipient)
+        EmailMessageRecipient.query \
+            .filter(EmailMessageRecipient.message_send_request_id.in_(recipient_ids)) \
+            .update({EmailMessageRecipient.send_attempt_time: self._current_time},
+                synchronize_session=False)
         db.session.commit()
-
-        
\ No newline at end of file
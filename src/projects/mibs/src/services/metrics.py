@@ -0,0 +1,93 @@
+"""
+In-process counters and gauges of the dispatcher, served in the Prometheus text format when
+MIBS_METRICS_PORT is set
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ as env
+from typing import Dict, Optional, Tuple
+from lib.logger.safezone_logger import get_logger
+
+LOGGER = get_logger(__name__)
+# Port of the metrics endpoint of the dispatcher. Not served when unset
+METRICS_PORT = env.get('MIBS_METRICS_PORT')
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    '''
+    Thread safe registry of counters and gauges identified by a name and labels
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+
+    def increment(self, name: str, value: float = 1, **labels: str):
+        ''' Add value to the counter name with the given labels '''
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        ''' Set the gauge name with the given labels to value '''
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges.setdefault(name, {})[key] = value
+
+    def get(self, name: str, **labels: str) -> Optional[float]:
+        ''' Return the value of a counter or gauge, or None if it was never set '''
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            for metrics in (self._counters, self._gauges):
+                if key in metrics.get(name, {}):
+                    return metrics[name][key]
+        return None
+
+    def render(self) -> str:
+        ''' Return every metric in the Prometheus text exposition format '''
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters), ('gauge', self._gauges)):
+                for name in sorted(metrics):
+                    lines.append(f'# TYPE {name} {kind}')
+                    for labels, value in sorted(metrics[name].items()):
+                        label_text = ','.join(f'{label}="{label_value}"'
+                            for label, label_value in labels)
+                        lines.append(f'{name}{{{label_text}}} {value}' if label_text
+                            else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the metrics registry in the Prometheus text format on GET
+    '''
+    def do_GET(self): # pylint: disable=invalid-name
+        ''' Serve the metrics registry '''
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        LOGGER.debug(format, *args)
+
+
+def start_metrics_server(port: Optional[str] = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    '''
+    Serve METRICS on port from a daemon thread. Returns the server, or None if port is unset
+    '''
+    if not port:
+        return None
+    server = ThreadingHTTPServer(('', int(port)), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='mibs-metrics', daemon=True).start()
+    LOGGER.info(f'Serving metrics on port {port}')
+    return server
@@ -0,0 +1,140 @@
+"""
+Priority lanes of the dispatcher. Every claim round is shared between:
+
+    due-now:  messages that became due less than MIBS_CATCH_UP_AFTER seconds ago
+    retry:    messages with a recipient waiting for another attempt
+    catch-up: messages overdue by more than MIBS_CATCH_UP_AFTER, the backlog left by an outage
+              or a restart
+
+Each lane is guaranteed its share of a round and may claim at most its batch size, so a large
+backlog is drained with the capacity fresh messages leave unused, without starving them.
+"""
+from datetime import datetime, timedelta
+from os import environ as env
+from typing import List, NamedTuple, Optional
+import sqlalchemy
+from models import EmailMessageRecipient, Message
+from lib.logger.safezone_logger import get_logger
+from services.metrics import METRICS, Metrics
+from services.retry_policy import recipient_is_due
+
+LOGGER = get_logger(__name__)
+# Messages due for longer than this are part of the catch-up backlog
+CATCH_UP_AFTER = timedelta(seconds=float(env.get('MIBS_CATCH_UP_AFTER', 300.0)))
+
+DUE_NOW = 'due-now'
+RETRY = 'retry'
+CATCH_UP = 'catch-up'
+
+
+class Lane(NamedTuple):
+    '''
+    A class of due messages. share is the fraction of a claim round guaranteed to the lane,
+    and batch_size the maximum number of its messages claimed in a round.
+    '''
+    name: str
+    share: float
+    batch_size: int
+
+    def criterion(self, now: datetime):
+        '''
+        Return the SQL criterion of the messages of the lane with a recipient due at now
+        '''
+        first_attempt = EmailMessageRecipient.attempt_count == 0
+        if self.name == RETRY:
+            first_attempt = sqlalchemy.not_(first_attempt)
+        criterion = sqlalchemy.exists().where(
+            EmailMessageRecipient.message_id == Message.message_id,
+            recipient_is_due(now),
+            first_attempt)
+        if self.name == DUE_NOW:
+            return sqlalchemy.and_(criterion, Message.send_time > now - CATCH_UP_AFTER)
+        if self.name == CATCH_UP:
+            return sqlalchemy.and_(criterion, Message.send_time <= now - CATCH_UP_AFTER)
+        return criterion
+
+
+def _lane_from_env(name: str, share: float, batch_size: int) -> Lane:
+    prefix = f'MIBS_LANE_{name.upper().replace("-", "_")}'
+    batch_size = int(env.get(f'{prefix}_BATCH_SIZE', batch_size))
+    if batch_size <= 0:
+        raise ValueError(f'{prefix}_BATCH_SIZE must be positive, got {batch_size}')
+    return Lane(name, float(env.get(f'{prefix}_SHARE', share)), batch_size)
+
+
+# In priority order: capacity a lane leaves unused goes to the next lanes first
+LANES: List[Lane] = [
+    _lane_from_env(DUE_NOW, 0.5, 100),
+    _lane_from_env(RETRY, 0.2, 50),
+    _lane_from_env(CATCH_UP, 0.3, 100),
+]
+
+
+def lane_limits(lanes: List[Lane], capacity: int) -> List[int]:
+    '''
+    Return the number of messages each lane is guaranteed in a round of capacity messages
+
+    Postcondition:
+        every lane with a positive share gets at least 1 if capacity allows, and the limits
+        add up to at most capacity
+    '''
+    limits = []
+    remaining = capacity
+    for lane in lanes:
+        limit = min(lane.batch_size, remaining, max(int(lane.share * capacity),
+            1 if lane.share > 0 else 0))
+        limits.append(limit)
+        remaining -= limit
+    return limits
+
+
+class CatchUpProgress:
+    '''
+    Tracks the size of the catch-up backlog and estimates when it will be drained from how
+    fast it shrinks
+    '''
+    def __init__(self, smoothing: float = 0.5, metrics: Metrics = METRICS):
+        assert 0 < smoothing <= 1
+        self._smoothing = smoothing
+        self._metrics = metrics
+        self._backlog: Optional[int] = None
+        self._measured_at: Optional[datetime] = None
+        self._drain_rate: Optional[float] = None
+
+    @property
+    def backlog(self) -> Optional[int]:
+        ''' The number of messages in the catch-up backlog when last measured '''
+        return self._backlog
+
+    def update(self, backlog: int, now: datetime):
+        '''
+        Record the size of the backlog at now and report the estimated time to drain it
+        '''
+        if self._backlog is not None and now > self._measured_at:
+            rate = (self._backlog - backlog) / (now - self._measured_at).total_seconds()
+            self._drain_rate = rate if self._drain_rate is None \
+                else self._smoothing * rate + (1 - self._smoothing) * self._drain_rate
+        if backlog == 0:
+            self._drain_rate = None
+        elif self._backlog == 0 or self._backlog is None:
+            LOGGER.warning(f'Catching up on {backlog} overdue message(s)')
+        self._backlog = backlog
+        self._measured_at = now
+
+        eta = self.eta_seconds()
+        self._metrics.set_gauge('mibs_catch_up_backlog', backlog)
+        self._metrics.set_gauge('mibs_catch_up_eta_seconds', -1 if eta is None else eta)
+        if backlog > 0:
+            LOGGER.info(f'Catch-up backlog: {backlog} message(s), estimated drain time: '
+                + ('unknown' if eta is None else f'{eta:.0f}s'))
+
+    def eta_seconds(self) -> Optional[float]:
+        '''
+        Return the estimated number of seconds until the backlog is drained, 0 if it is
+        empty, or None if it is not shrinking
+        '''
+        if self._backlog == 0:
+            return 0.0
+        if self._drain_rate is None or self._drain_rate <= 0:
+            return None
+        return self._backlog / self._drain_rate
@@ -0,0 +1,191 @@
+"""
+Token bucket rate limiting of outbound email, with a global bucket shared by every recipient and
+a bucket per recipient domain. Recipients over the limit are not waited on: they are handed back
+to be deferred until the buckets have refilled.
+
+Limits are read from the environment and can be changed while the dispatcher runs, either with
+RateLimiter.configure or by editing the JSON file named by MIBS_RATE_LIMIT_FILE:
+
+    {"rate": 50, "burst": 100, "domain_rate": 10, "domain_burst": 20,
+     "domains": {"gmail.com": {"rate": 20, "burst": 40}}}
+"""
+import json
+import math
+import os
+import threading
+import time
+from os import environ as env
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+from lib.logger.safezone_logger import get_logger
+from services.metrics import METRICS, Metrics
+
+LOGGER = get_logger(__name__)
+# Recipients sent per second across every domain, 0 for no limit
+RATE_LIMIT = float(env.get('MIBS_RATE_LIMIT', 0))
+# Recipients that can be sent at once after an idle period
+RATE_BURST = float(env.get('MIBS_RATE_BURST', max(RATE_LIMIT, 1)))
+# Recipients sent per second to a single domain, 0 for no limit
+DOMAIN_RATE_LIMIT = float(env.get('MIBS_DOMAIN_RATE_LIMIT', 0))
+DOMAIN_RATE_BURST = float(env.get('MIBS_DOMAIN_RATE_BURST', max(DOMAIN_RATE_LIMIT, 1)))
+# JSON file with limits reloaded when it changes, see the module documentation
+RATE_LIMIT_FILE = env.get('MIBS_RATE_LIMIT_FILE')
+
+
+class Limit(NamedTuple):
+    '''
+    A rate in tokens per second and a bucket size. A rate of 0 means no limit.
+    '''
+    rate: float
+    burst: float
+
+
+class TokenBucket:
+    '''
+    Bucket of at most limit.burst tokens refilled at limit.rate tokens per second.
+    Not thread safe, RateLimiter serializes access.
+    '''
+    def __init__(self, limit: Limit, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._limit = limit
+        self._tokens = limit.burst
+        self._updated = clock()
+
+    def set_limit(self, limit: Limit):
+        '''
+        Change the limit, keeping the tokens already in the bucket up to the new size.
+        A bucket that had no limit starts full.
+        '''
+        if self._limit.rate <= 0:
+            self._tokens = limit.burst
+            self._updated = self._clock()
+        self.available()
+        self._limit = limit
+        self._tokens = min(self._tokens, limit.burst)
+
+    def available(self) -> float:
+        ''' Refill the bucket and return the number of tokens in it '''
+        if self._limit.rate <= 0:
+            return math.inf
+        now = self._clock()
+        self._tokens = min(self._limit.burst,
+            self._tokens + (now - self._updated) * self._limit.rate)
+        self._updated = now
+        return self._tokens
+
+    def take(self, count: int):
+        ''' Remove count available tokens '''
+        if self._limit.rate > 0:
+            self._tokens -= count
+
+    def seconds_until(self, count: int) -> float:
+        ''' Return how long until count tokens, at most a full bucket, are available '''
+        if self._limit.rate <= 0:
+            return 0.0
+        missing = min(count, self._limit.burst) - self.available()
+        return max(missing, 0.0) / self._limit.rate
+
+
+class RateLimiter:
+    '''
+    Thread safe global and per domain token buckets, one token per recipient
+    '''
+    def __init__(self, limit: Limit = Limit(RATE_LIMIT, RATE_BURST),
+            domain_limit: Limit = Limit(DOMAIN_RATE_LIMIT, DOMAIN_RATE_BURST), *,
+            domain_limits: Dict[str, Limit] = None, config_file: Optional[str] = RATE_LIMIT_FILE,
+            clock: Callable[[], float] = time.monotonic, metrics: Metrics = METRICS):
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._metrics = metrics
+        self._bucket = TokenBucket(limit, clock)
+        self._domain_limit = domain_limit
+        self._domain_limits: Dict[str, Limit] = {}
+        self._domain_buckets: Dict[str, TokenBucket] = {}
+        self._config_file = config_file
+        self._config_mtime = None
+        self.configure(limit, domain_limit, domain_limits or {})
+        self.reload_if_changed()
+
+    def configure(self, limit: Limit = None, domain_limit: Limit = None,
+            domain_limits: Dict[str, Limit] = None):
+        '''
+        Change the limits of the running limiter. Arguments left to None are unchanged.
+        domain_limits replaces every per domain override of domain_limit.
+        '''
+        with self._lock:
+            if limit is not None:
+                self._bucket.set_limit(limit)
+                self._metrics.set_gauge('mibs_rate_limit', limit.rate, domain='*')
+            if domain_limit is not None:
+                self._domain_limit = domain_limit
+            if domain_limits is not None:
+                self._domain_limits = {domain.lower(): override
+                    for domain, override in domain_limits.items()}
+            for domain, bucket in self._domain_buckets.items():
+                bucket.set_limit(self._limit_of(domain))
+            for domain, override in self._domain_limits.items():
+                self._metrics.set_gauge('mibs_rate_limit', override.rate, domain=domain)
+        LOGGER.info('Rate limits configured')
+
+    def reload_if_changed(self):
+        '''
+        Reconfigure from the limit file if it changed since it was last read
+        '''
+        if not self._config_file:
+            return
+        try:
+            mtime = os.stat(self._config_file).st_mtime
+            if mtime == self._config_mtime:
+                return
+            with open(self._config_file, encoding='utf-8') as config_file:
+                config = json.load(config_file)
+            self._config_mtime = mtime
+        except (OSError, ValueError):
+            LOGGER.exception(f'Could not read rate limits from {self._config_file}')
+            return
+
+        def limit(values, rate_key, burst_key):
+            if rate_key not in values:
+                return None
+            rate = float(values[rate_key])
+            return Limit(rate, float(values.get(burst_key, max(rate, 1))))
+
+        self.configure(limit(config, 'rate', 'burst'),
+            limit(config, 'domain_rate', 'domain_burst'),
+            {domain: limit(values, 'rate', 'burst')
+                for domain, values in config.get('domains', {}).items() if 'rate' in values})
+
+    def acquire(self, domain: str, count: int) -> Tuple[int, float]:
+        '''
+        Take up to count tokens from the global bucket and the bucket of domain
+
+        Preconditions:
+            count is a positive integer
+        Postcondition:
+            returns (granted, retry_after) where granted is the number of recipients that
+            can be sent now, and retry_after the number of seconds until the count - granted
+            others can be
+        '''
+        assert count > 0
+        with self._lock:
+            domain_bucket = self._domain_buckets.get(domain)
+            if domain_bucket is None:
+                domain_bucket = TokenBucket(self._limit_of(domain), self._clock)
+                self._domain_buckets[domain] = domain_bucket
+            granted = int(min(count, self._bucket.available(), domain_bucket.available()))
+            self._bucket.take(granted)
+            domain_bucket.take(granted)
+            retry_after = 0.0
+            if granted < count:
+                retry_after = max(self._bucket.seconds_until(count - granted),
+                    domain_bucket.seconds_until(count - granted))
+
+        label = domain if domain in self._domain_limits else '*'
+        if granted > 0:
+            self._metrics.increment('mibs_rate_limit_granted_total', granted, domain=label)
+        if granted < count:
+            self._metrics.increment('mibs_rate_limit_deferred_total', count - granted,
+                domain=label)
+        return granted, retry_after
+
+    def _limit_of(self, domain: str) -> Limit:
+        return self._domain_limits.get(domain, self._domain_limit)
@@ -0,0 +1,60 @@
+"""
+Retry schedule of recipients whose email could not be sent: exponential backoff with jitter,
+so retries of a failing relay or address spread out instead of arriving in bursts
+"""
+import random
+from datetime import datetime, timedelta
+from os import environ as env
+from typing import Optional
+import sqlalchemy
+from models import EmailMessageRecipient
+
+# Delay before the first retry of a recipient
+RETRY_BASE_DELAY = timedelta(seconds=float(env.get('MIBS_RETRY_BASE_DELAY', 30.0)))
+# Upper bound of the delay between two attempts
+RETRY_MAX_DELAY = timedelta(seconds=float(env.get('MIBS_RETRY_MAX_DELAY', 3600.0)))
+# A recipient is dead lettered once this many attempts have failed
+MAX_SEND_ATTEMPTS = int(env.get('MIBS_MAX_SEND_ATTEMPTS', 10))
+
+
+def retry_delay(attempt_count: int, rng: random.Random = random) -> timedelta:
+    '''
+    Return the delay before the next attempt of a recipient that failed attempt_count times
+
+    Preconditions:
+        attempt_count is a positive integer
+    Postcondition:
+        returns a delay between half and all of
+        min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt_count - 1))
+    '''
+    assert isinstance(attempt_count, int) and attempt_count > 0
+    # cap the exponent so the multiplication can not overflow timedelta
+    backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** min(attempt_count - 1, 32))
+    return backoff * rng.uniform(0.5, 1.0)
+
+
+def next_attempt_at(attempt_count: int, now: datetime, rng: random.Random = random) -> datetime:
+    '''
+    Return when a recipient that failed attempt_count times should be attempted again
+    '''
+    return now + retry_delay(attempt_count, rng)
+
+
+def should_dead_letter(attempt_count: int, smtp_code: Optional[int]) -> bool:
+    '''
+    Return True if a recipient that failed attempt_count times, the last time with the
+    given SMTP reply code, must not be attempted again: the attempt limit is reached, or
+    the server gave a permanent (5xx) error
+    '''
+    return attempt_count >= MAX_SEND_ATTEMPTS \
+        or (smtp_code is not None and 500 <= smtp_code < 600)
+
+
+def recipient_is_due(now: datetime):
+    '''
+    Return the SQL criterion of unsent recipients whose next attempt is due at now.
+    Recipients that were never attempted are due with their message.
+    '''
+    return sqlalchemy.and_(EmailMessageRecipient.sent.is_(False),
+        sqlalchemy.or_(EmailMessageRecipient.next_attempt_at.is_(None),
+            EmailMessageRecipient.next_attempt_at <= now))
@@ -0,0 +1,167 @@
+"""
+Pool of kept-alive SMTP connections shared by every send in the process
+"""
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from os import environ as env
+from typing import Callable, List
+from lib.logger.safezone_logger import get_logger
+
+LOGGER = get_logger(__name__)
+# Maximum number of open connections to the relay
+SMTP_POOL_SIZE = int(env.get('MIBS_SMTP_POOL_SIZE', 16))
+# A connection is closed and replaced after sending this many messages
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(env.get('MIBS_SMTP_MAX_MESSAGES_PER_CONNECTION', 100))
+# Idle connections are closed after this many seconds
+SMTP_IDLE_TIMEOUT = float(env.get('MIBS_SMTP_IDLE_TIMEOUT', 30.0))
+# Idle connections are checked with a NOOP before reuse after this many seconds
+SMTP_HEALTH_CHECK_AFTER = float(env.get('MIBS_SMTP_HEALTH_CHECK_AFTER', 5.0))
+# Socket timeout for connecting and talking to the relay, in seconds
+SMTP_TIMEOUT = float(env.get('MIBS_SMTP_TIMEOUT', 30.0))
+
+
+class _PooledConnection:
+    '''
+    An open SMTP connection and its usage
+    '''
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+
+class SmtpConnectionPool:
+    '''
+    Thread safe pool of at most max_size SMTP connections to a single relay
+    '''
+    def __init__(self, host: str, port: int, *, max_size: int = SMTP_POOL_SIZE,
+            max_messages: int = SMTP_MAX_MESSAGES_PER_CONNECTION,
+            idle_timeout: float = SMTP_IDLE_TIMEOUT,
+            health_check_after: float = SMTP_HEALTH_CHECK_AFTER,
+            timeout: float = SMTP_TIMEOUT,
+            smtp_factory: Callable[..., smtplib.SMTP] = smtplib.SMTP):
+        assert max_size > 0
+        assert max_messages > 0
+        self._host = host
+        self._port = port
+        self._max_size = max_size
+        self._max_messages = max_messages
+        self._idle_timeout = idle_timeout
+        self._health_check_after = health_check_after
+        self._timeout = timeout
+        self._smtp_factory = smtp_factory
+        self._idle: List[_PooledConnection] = []
+        self._open_count = 0
+        self._available = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        '''
+        Borrow a connection for one send
+
+        Postcondition:
+            the connection is returned to the pool, or closed if it reached the maximum
+            number of messages or the send failed without a reply from the server
+        '''
+        pooled = self._acquire()
+        reusable = True
+        try:
+            yield pooled.server
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # the server rejected the email but the connection is still usable
+            raise
+        except BaseException:
+            reusable = False
+            raise
+        finally:
+            pooled.messages_sent += 1
+            self._release(pooled, reusable and pooled.messages_sent < self._max_messages)
+
+    def close(self):
+        ''' Close every idle connection '''
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+            self._available.notify_all()
+        for pooled in idle:
+            self._quit(pooled)
+
+    def _acquire(self) -> _PooledConnection:
+        while True:
+            pooled = None
+            with self._available:
+                expired = self._pop_expired()
+                while not self._idle and self._open_count >= self._max_size:
+                    self._available.wait()
+                    expired += self._pop_expired()
+                if self._idle:
+                    # most recently used first, so rarely used connections expire
+                    pooled = self._idle.pop()
+                else:
+                    self._open_count += 1
+            for expired_connection in expired:
+                self._quit(expired_connection)
+
+            if pooled is None:
+                return self._open()
+            if self._is_healthy(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def _open(self) -> _PooledConnection:
+        try:
+            LOGGER.debug(f'Opening SMTP connection to {self._host}:{self._port}')
+            return _PooledConnection(
+                self._smtp_factory(self._host, self._port, timeout=self._timeout))
+        except BaseException:
+            with self._available:
+                self._open_count -= 1
+                self._available.notify()
+            raise
+
+    def _release(self, pooled: _PooledConnection, reusable: bool):
+        if not reusable:
+            self._discard(pooled)
+            return
+        pooled.last_used = time.monotonic()
+        with self._available:
+            self._idle.append(pooled)
+            self._available.notify()
+
+    def _discard(self, pooled: _PooledConnection):
+        with self._available:
+            self._open_count -= 1
+            self._available.notify()
+        self._quit(pooled)
+
+    def _is_healthy(self, pooled: _PooledConnection) -> bool:
+        if time.monotonic() - pooled.last_used < self._health_check_after:
+            return True
+        try:
+            status, _ = pooled.server.noop()
+            return status == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _pop_expired(self) -> List[_PooledConnection]:
+        '''
+        Remove and return the connections idle for longer than the idle timeout.
+        Caller must hold the lock and quit the returned connections.
+        '''
+        now = time.monotonic()
+        expired = [pooled for pooled in self._idle
+            if now - pooled.last_used >= self._idle_timeout]
+        if expired:
+            self._idle = [pooled for pooled in self._idle if pooled not in expired]
+            self._open_count -= len(expired)
+            self._available.notify(len(expired))
+        return expired
+
+    @staticmethod
+    def _quit(pooled: _PooledConnection):
+        try:
+            pooled.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pooled.server.close()
@@ -0,0 +1,160 @@
+"""
+Transports handing the emails of the dispatcher over for delivery, selected with MIBS_TRANSPORT:
+
+    smtp:    pooled connections to the SMTP relay at MIBS_SMTP_HOST:MIBS_SMTP_PORT (default)
+    maildir: a local maildir spool at MIBS_MAILDIR_PATH, for a separate relay to pick up
+    memory:  an in-process sink with injected latency and failures, to benchmark and load test
+             the dispatcher without a mail server
+
+Every transport sends like smtplib.SMTP.sendmail: it returns the recipients that were refused
+and raises when none was accepted or the email could not be handed over at all.
+"""
+import mailbox
+import os
+from abc import ABC, abstractmethod
+import random
+import smtplib
+import threading
+import time
+from email import message_from_string
+from os import environ as env
+from typing import Dict, List, NamedTuple, Tuple
+from lib.logger.safezone_logger import get_logger
+from services.smtp_pool import SmtpConnectionPool
+
+LOGGER = get_logger(__name__)
+# Name of the transport the dispatcher sends with, see the module documentation
+TRANSPORT = env.get('MIBS_TRANSPORT', 'smtp')
+SMTP_HOST_PORT = int(env.get('MIBS_SMTP_PORT', 25))
+SMTP_HOST = env.get('MIBS_SMTP_HOST', 'smtp-dev')
+# Directory of the maildir spool of the maildir transport, created if missing
+MAILDIR_PATH = env.get('MIBS_MAILDIR_PATH', '/var/spool/mibs')
+# Seconds each send of the memory transport takes
+MEMORY_LATENCY = float(env.get('MIBS_MEMORY_LATENCY', 0.0))
+# Probability that a send of the memory transport fails as if the relay were unreachable
+MEMORY_FAILURE_RATE = float(env.get('MIBS_MEMORY_FAILURE_RATE', 0.0))
+# Probability that the memory transport refuses a recipient with a temporary error
+MEMORY_REFUSE_RATE = float(env.get('MIBS_MEMORY_REFUSE_RATE', 0.0))
+
+Refused = Dict[str, Tuple[int, bytes]]
+
+
+class Transport(ABC):
+    '''
+    Hands emails over for delivery. Implementations are thread safe.
+    '''
+    @abstractmethod
+    def send(self, sender: str, recipients: List[str], content: str) -> Refused:
+        '''
+        Send content from sender to every address in recipients
+
+        Preconditions:
+            recipients is not empty
+        Postcondition:
+            returns {email: (code, response)} for the addresses that were refused, and raises
+            smtplib.SMTPRecipientsRefused if all of them were, or another smtplib.SMTPException
+            or OSError if the email could not be handed over at all
+        '''
+
+    def close(self):
+        ''' Release the resources kept for later sends '''
+
+
+class SmtpTransport(Transport):
+    '''
+    Sends over a pool of kept-alive connections to an SMTP relay
+    '''
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_HOST_PORT, **pool_options):
+        self.pool = SmtpConnectionPool(host, port, **pool_options)
+
+    def send(self, sender: str, recipients: List[str], content: str) -> Refused:
+        with self.pool.connection() as server:
+            return server.sendmail(sender, recipients, content)
+
+    def close(self):
+        self.pool.close()
+
+
+class MaildirTransport(Transport):
+    '''
+    Spools every email to a maildir, with its envelope in the X-Envelope-From and
+    X-Envelope-To headers
+    '''
+    def __init__(self, path: str = MAILDIR_PATH):
+        # mailbox only creates the subdirectories along with a missing maildir
+        for subdirectory in ('tmp', 'new', 'cur'):
+            os.makedirs(os.path.join(path, subdirectory), exist_ok=True)
+        self._maildir = mailbox.Maildir(path, create=True)
+        self._lock = threading.Lock()
+
+    def send(self, sender: str, recipients: List[str], content: str) -> Refused:
+        assert len(recipients) > 0
+        email = message_from_string(content)
+        email['X-Envelope-From'] = sender
+        email['X-Envelope-To'] = ', '.join(recipients)
+        with self._lock:
+            self._maildir.add(email)
+        return {}
+
+
+class SentEmail(NamedTuple):
+    '''
+    An email accepted by the memory transport
+    '''
+    sender: str
+    recipients: List[str]
+    content: str
+
+
+class MemoryTransport(Transport):
+    '''
+    Keeps the last max_kept accepted emails in memory. Each send sleeps for latency seconds,
+    fails like an unreachable relay with probability failure_rate, and refuses each recipient
+    with a temporary error with probability refuse_rate.
+    '''
+    def __init__(self, latency: float = MEMORY_LATENCY, failure_rate: float = MEMORY_FAILURE_RATE,
+            refuse_rate: float = MEMORY_REFUSE_RATE, max_kept: int = 1000,
+            rng: random.Random = None):
+        assert latency >= 0
+        assert 0 <= failure_rate <= 1 and 0 <= refuse_rate <= 1
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.refuse_rate = refuse_rate
+        self._max_kept = max_kept
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self.sent: List[SentEmail] = []
+        self.sent_count = 0
+
+    def send(self, sender: str, recipients: List[str], content: str) -> Refused:
+        assert len(recipients) > 0
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            if self._rng.random() < self.failure_rate:
+                raise smtplib.SMTPServerDisconnected('Injected connection failure')
+            refused = {recipient: (451, b'Injected temporary failure')
+                for recipient in recipients if self._rng.random() < self.refuse_rate}
+            if len(refused) == len(recipients):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            self.sent_count += 1
+            self.sent.append(SentEmail(sender,
+                [recipient for recipient in recipients if recipient not in refused], content))
+            if len(self.sent) > self._max_kept:
+                del self.sent[0]
+        return refused
+
+
+def create_transport(name: str = TRANSPORT) -> Transport:
+    '''
+    Return a new transport of the given name, see the module documentation
+    '''
+    transports = {
+        'smtp': SmtpTransport,
+        'maildir': MaildirTransport,
+        'memory': MemoryTransport,
+    }
+    if name not in transports:
+        raise ValueError(f'Unknown transport {name}, expected one of {sorted(transports)}')
+    LOGGER.info(f'Sending emails with the {name} transport')
+    return transports[name]()
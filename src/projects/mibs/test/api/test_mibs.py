@@ -2,6 +2,7 @@
 /mibs endpoint unit tests
 '''
 import unittest
+import sqlalchemy
 
 import time
 import jwt
@@ -9,15 +10,16 @@ import re
 from urllib.parse import urlparse, parse_qs
 from dateutil.parser import parse as datetimeParse
 from datetime import datetime
-from api.mibs import mibs_blueprint, delete_mibs_for_user
+from api.mibs import DEFAULT_PAGE_SIZE, mibs_blueprint, delete_mibs_for_user
 from models import Message, EmailMessageRecipient, db
+from services.due_notifications import subscribe_local, unsubscribe_local
 from flask import Flask
 from http import HTTPStatus
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from auth_init import auth
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 test_email = 'test@email.com'
 test_user_id = 'test-user'
@@ -434,6 +436,124 @@ class TestMibsApi(unittest.TestCase):
                 self.test_post_message['recipients'][1]['email'])
             self.assertFalse(message.email_recipients[1].sent)
 
+    def test_post_publishes_message_due(self):
+        '''
+        Test POST /mibs notifies the message pooling service of the new message
+        '''
+        notifications = []
+        def callback(message_id, send_time):
+            notifications.append((message_id, send_time))
+        subscribe_local(callback)
+        try:
+            response = self.client.post(
+                '/mibs',
+                json=self.test_post_message,
+                headers={'Authorization': 'Bearer ' + self.get_token()}
+            )
+        finally:
+            unsubscribe_local(callback)
+
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        message_id = int(parse_qs(urlparse(response.headers['Location']).query)['messageId'][0])
+        self.assertEqual(notifications, [(message_id,
+            datetimeParse(self.test_post_message['sendTime']).replace(tzinfo=None))])
+
+    def test_post_batch_success(self):
+        '''
+        Test POST /mibs/batch creates every mib of the batch and notifies the pooling service
+        '''
+        batch = [dict(self.test_post_message, message=f'test message {i}',
+                recipients=[{'email': f'test{i}.{j}@email.com'} for j in range(i + 1)])
+            for i in range(3)]
+        notifications = []
+        def callback(message_id, send_time):
+            del send_time
+            notifications.append(message_id)
+        subscribe_local(callback)
+        try:
+            response = self.client.post('/mibs/batch', json=batch,
+                headers={'Authorization': 'Bearer ' + self.get_token()})
+        finally:
+            unsubscribe_local(callback)
+
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        results = response.get_json()
+        self.assertEqual(len(results), 3)
+        message_ids = [result['messageId'] for result in results]
+        self.assertEqual(notifications, message_ids)
+        with self.app.app_context():
+            for i, result in enumerate(results):
+                self.assertEqual(int(parse_qs(urlparse(result['location']).query)['messageId'][0]),
+                    result['messageId'])
+                message = Message.query.get(result['messageId'])
+                self.assertEqual(message.user_id, test_user_id)
+                self.assertEqual(message.message, f'test message {i}')
+                self.assertFalse(message.sent)
+                self.assertEqual(sorted(recipient.email for recipient in message.email_recipients),
+                    [f'test{i}.{j}@email.com' for j in range(i + 1)])
+                self.assertTrue(all(recipient.attempt_count == 0 and not recipient.sent
+                    for recipient in message.email_recipients))
+
+    def test_post_batch_inserts_recipients_in_one_statement(self):
+        '''
+        Test POST /mibs/batch inserts the recipients of every mib with a single INSERT
+        '''
+        batch = [dict(self.test_post_message,
+                recipients=[{'email': f'test{i}.{j}@email.com'} for j in range(5)])
+            for i in range(20)]
+        with self.app.app_context():
+            engine = db.engine
+        statements = []
+        def record_statement(statement, **_kwargs):
+            statements.append(statement)
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', record_statement, named=True)
+        try:
+            response = self.client.post('/mibs/batch', json=batch,
+                headers={'Authorization': 'Bearer ' + self.get_token()})
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', record_statement)
+
+        self.assertEqual(response.status_code, HTTPStatus.CREATED)
+        self.assertEqual(len([statement for statement in statements
+            if statement.startswith('INSERT INTO "EmailMessageRecipient"')]), 1)
+        with self.app.app_context():
+            self.assertEqual(EmailMessageRecipient.query.count(), 100)
+
+    def test_post_batch_with_invalid_mib(self):
+        '''
+        Test POST /mibs/batch creates nothing and reports every invalid mib
+        '''
+        batch = [self.test_post_message, self.test_post_invalid_email_recipient_1,
+            self.test_post_message, dict(self.test_post_message, message='')]
+        response = self.client.post('/mibs/batch', json=batch,
+            headers={'Authorization': 'Bearer ' + self.get_token()})
+
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertEqual(response.get_json(), [
+            {'index': 1, 'error': 'invalid email in request body'},
+            {'index': 3, 'error': 'message cannot be empty'},
+        ])
+        self.assertEqual(self.get_num_user_messages(), 0)
+
+    def test_post_batch_invalid_body(self):
+        '''
+        Test POST /mibs/batch when the request body is not a non empty array of mibs
+        '''
+        for body, error in [
+                (self.test_post_message, b'Request body must be a JSON array of MessageInABottle'),
+                ([], b'Must have at least 1 MessageInABottle')]:
+            response = self.client.post('/mibs/batch', json=body,
+                headers={'Authorization': 'Bearer ' + self.get_token()})
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+            self.assertEqual(response.data, error)
+
+        with patch('api.mibs.MAX_BATCH_SIZE', 2):
+            response = self.client.post('/mibs/batch', json=[self.test_post_message] * 3,
+                headers={'Authorization': 'Bearer ' + self.get_token()})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertEqual(response.data, b"Can't have more than 2 MessageInABottle in a batch")
+        self.assertEqual(self.get_num_user_messages(), 0)
+
     def test_put_not_json(self):
         '''
         Test PUT /mibs when content type is not application/json
@@ -1040,6 +1160,107 @@ class TestMibsApi(unittest.TestCase):
         self.assertEqual(data[0]['message_id'], 2)
         self.assertEqual(status, HTTPStatus.OK)
 
+    def test_get_pages_with_cursor(self):
+        '''
+        Test GET /mibs returns the mibs of the user page by page, following the next links
+        '''
+        self.populate_messages()
+        message_ids = []
+        url = '/mibs?limit=2'
+        pages = 0
+        while url is not None:
+            response = self.client.get(url,
+                headers={'Authorization': 'Bearer ' + self.get_token()})
+            self.assertEqual(response.status_code, HTTPStatus.OK)
+            data = response.get_json()
+            self.assertLessEqual(len(data), 2)
+            message_ids += [mib['message_id'] for mib in data]
+            pages += 1
+            link = response.headers.get('Link')
+            url = None
+            if link is not None:
+                url = re.fullmatch(r'<(.*)>; rel="next"', link).group(1)
+                self.assertEqual(parse_qs(urlparse(url).query)['cursor'],
+                    [response.headers['X-Next-Cursor']])
+        self.assertEqual(message_ids, [1, 2, 5, 6, 9])
+        self.assertEqual(pages, 3)
+
+    def test_get_without_pagination_returns_every_mib(self):
+        '''
+        Test GET /mibs without limit or cursor returns every mib, however many there are
+        '''
+        with self.app.app_context():
+            for message_id in range(1, DEFAULT_PAGE_SIZE + 6):
+                db.session.add(Message(message_id=message_id, user_id=test_user_id,
+                    message='test', send_time=datetime.now(),
+                    email_recipients=[EmailMessageRecipient(email=f'test{message_id}@email.com')]))
+            db.session.commit()
+        response = self.client.get('/mibs',
+            headers={'Authorization': 'Bearer ' + self.get_token()})
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual([mib['message_id'] for mib in response.get_json()],
+            list(range(1, DEFAULT_PAGE_SIZE + 6)))
+        self.assertNotIn('Link', response.headers)
+
+    def test_get_last_page_has_no_next_link(self):
+        '''
+        Test GET /mibs does not link to a next page when every mib fits in the page
+        '''
+        self.populate_messages()
+        response = self.client.get('/mibs?limit=5',
+            headers={'Authorization': 'Bearer ' + self.get_token()})
+        self.assertEqual(len(response.get_json()), 5)
+        self.assertNotIn('Link', response.headers)
+
+    def test_get_invalid_limit(self):
+        '''
+        Test GET /mibs with a limit that is not a positive integer
+        '''
+        for limit in ['0', '-1', 'ten']:
+            response = self.client.get(f'/mibs?limit={limit}',
+                headers={'Authorization': 'Bearer ' + self.get_token()})
+            self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+            self.assertEqual(response.data, b'invalid limit: limit must be a positive integer')
+
+    def test_get_invalid_cursor(self):
+        '''
+        Test GET /mibs with a cursor it did not return
+        '''
+        response = self.client.get('/mibs?cursor=notacursor',
+            headers={'Authorization': 'Bearer ' + self.get_token()})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertEqual(response.data, b'invalid cursor')
+
+    def test_get_loads_recipients_in_one_query(self):
+        '''
+        Test GET /mibs loads the recipients of every mib of a page with a single query
+        '''
+        with self.app.app_context():
+            for message_id in range(1, 51):
+                db.session.add(Message(message_id=message_id, user_id=test_user_id,
+                    message='test', send_time=datetime.now(),
+                    email_recipients=[EmailMessageRecipient(email=f'test{message_id}.{i}@email.com')
+                        for i in range(2)]))
+            db.session.commit()
+            engine = db.engine
+
+        statements = []
+        def record_statement(statement, **_kwargs):
+            statements.append(statement)
+        for url, expected_count in [('/mibs', 50), ('/mibs?messageId=7', 1)]:
+            statements.clear()
+            sqlalchemy.event.listen(engine, 'before_cursor_execute', record_statement, named=True)
+            try:
+                response = self.client.get(url,
+                    headers={'Authorization': 'Bearer ' + self.get_token()})
+            finally:
+                sqlalchemy.event.remove(engine, 'before_cursor_execute', record_statement)
+
+            data = response.get_json()
+            self.assertEqual(len(data), expected_count)
+            self.assertTrue(all(len(mib['recipients']) == 2 for mib in data))
+            self.assertEqual(len(statements), 2, statements)
+
     def create_email_recipient(self,
                                message_send_request_id=1,
                                message_id=test_message_id,
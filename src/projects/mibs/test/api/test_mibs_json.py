@@ -0,0 +1,62 @@
+'''
+GET /mibs JSON encoding unit tests
+'''
+import unittest
+from datetime import datetime, timedelta, timezone
+from flask import Flask, jsonify
+from werkzeug.http import http_date
+from lib.mibs.python.openapi.swagger_server.models import MessageInABottle, EmailRecipient
+from api.mibs_json import encode_mib_rows, encode_mibs, _http_date
+from models import Message, EmailMessageRecipient
+
+
+class TestMibsJson(unittest.TestCase):
+    '''
+    Checks the encoder against the swagger models and flask.jsonify it replaces
+    '''
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.mibs = [
+            Message(message_id=1, message='Hello!', send_time=datetime(2021, 10, 27, 23, 22, 19),
+                email_recipients=[EmailMessageRecipient(email='test@email.com')]),
+            Message(message_id=42, message='"Quotes", \\backslashes\\ and\nnew lines\t',
+                send_time=datetime(2022, 1, 2, 3, 4, 5, 678901),
+                email_recipients=[EmailMessageRecipient(email='a@email.com'),
+                    EmailMessageRecipient(email='b+tag@email.com')]),
+            Message(message_id=7, message='Non ASCII: café ☕ \U0001f30a </script>',
+                send_time=datetime(1999, 12, 31, 23, 59, 59), email_recipients=[]),
+        ]
+
+    def swagger_json(self, mibs):
+        with self.app.app_context():
+            return jsonify([MessageInABottle(message_id=m.message_id,
+                    message=m.message,
+                    send_time=m.send_time,
+                    recipients=[EmailRecipient(email=er.email)
+                        for er in m.email_recipients]).to_dict()
+                for m in mibs]).get_data()
+
+    def test_same_output_as_swagger_models(self):
+        self.assertEqual(encode_mibs(self.mibs), self.swagger_json(self.mibs))
+        for mib in self.mibs:
+            self.assertEqual(encode_mibs([mib]), self.swagger_json([mib]))
+
+    def test_empty_list(self):
+        self.assertEqual(encode_mibs([]), self.swagger_json([]))
+
+    def test_rows(self):
+        rows = [(m.message_id, m.message, m.send_time, [er.email for er in m.email_recipients])
+            for m in self.mibs]
+        self.assertEqual(encode_mib_rows(rows), self.swagger_json(self.mibs))
+
+    def test_http_date(self):
+        value = datetime(2020, 2, 28, 22, 30, 1)
+        for _ in range(500):
+            value += timedelta(hours=13, seconds=7)
+            self.assertEqual(_http_date(value), http_date(value))
+            aware = value.replace(tzinfo=timezone(timedelta(hours=-6)))
+            self.assertEqual(_http_date(aware), http_date(aware))
+
+
+if __name__ == '__main__':
+    unittest.main()
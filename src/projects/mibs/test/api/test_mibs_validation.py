@@ -0,0 +1,68 @@
+'''
+POST and PUT /mibs request validation unit tests
+'''
+import unittest
+from datetime import datetime, timezone
+from api.mibs_validation import MibRequest, validate_mib
+
+
+class TestMibsValidation(unittest.TestCase):
+    '''
+    POST and PUT /mibs request validation unit tests
+    '''
+    def setUp(self):
+        self.body = {
+            'message': 'test message',
+            'recipients': [{'email': 'test@email.com'}, {'email': 'other.test@email.com'}],
+            'sendTime': '2021-10-27T23:22:19.911Z',
+        }
+
+    def test_valid_body(self):
+        mib, error = validate_mib(self.body)
+        self.assertIsNone(error)
+        self.assertEqual(mib, MibRequest(None, 'test message',
+            datetime(2021, 10, 27, 23, 22, 19, 911000, tzinfo=timezone.utc),
+            ['test@email.com', 'other.test@email.com']))
+
+    def test_valid_put_body(self):
+        self.body['messageId'] = 3
+        mib, error = validate_mib(self.body, is_put=True)
+        self.assertIsNone(error)
+        self.assertEqual(mib.message_id, 3)
+
+    def test_every_recipient_is_validated(self):
+        self.body['recipients'].append({'email': 'test@.com'})
+        self.assertEqual(validate_mib(self.body), (None, 'invalid email in request body'))
+
+        self.body['recipients'][-1] = {'email': 42}
+        self.assertEqual(validate_mib(self.body), (None, 'invalid email in request body'))
+
+    def test_invalid_types(self):
+        self.assertEqual(validate_mib([self.body]),
+            (None, 'Request body must be a JSON object'))
+
+        self.body['messageId'] = True
+        self.assertEqual(validate_mib(self.body, is_put=True),
+            (None, 'invalid messageId: messageId must be an integer'))
+
+        self.body['message'] = ['test message']
+        self.assertEqual(validate_mib(self.body), (None, 'message must be a string'))
+
+        self.body['message'] = 'test message'
+        self.body['recipients'] = {'email': 'test@email.com'}
+        self.assertEqual(validate_mib(self.body), (None, 'recipients must be a list'))
+
+    def test_unknown_recipients(self):
+        self.body['recipients'] = ['test@email.com', {'phoneNumber': '555'}]
+        self.assertEqual(validate_mib(self.body),
+            (None, 'Unknown recipient types: ["test@email.com", {"phoneNumber": "555"}]'))
+
+    def test_invalid_send_time(self):
+        for send_time in ['tomorrow', 20211027, None]:
+            self.body['sendTime'] = send_time
+            self.assertEqual(validate_mib(self.body),
+                (None, '"sendTime" is not an ISO-8601 UTC date time string'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+'''
+    Schema upgrade unittest
+'''
+import unittest
+from unittest.mock import MagicMock, patch
+import sqlalchemy
+from flask import Flask
+from models import Message, db
+from models.schema import SCHEMA_LOCK_KEY, upgrade_schema
+
+# The tables of the first release
+OLD_SCHEMA = [
+    '''CREATE TABLE "Message" (
+        "messageId" INTEGER PRIMARY KEY,
+        "userId" VARCHAR NOT NULL,
+        "message" TEXT NOT NULL,
+        "sendTime" DATETIME NOT NULL,
+        "sent" BOOLEAN NOT NULL,
+        "lastSentTime" DATETIME)''',
+    '''CREATE TABLE "EmailMessageRecipient" (
+        "messageSendRequestId" INTEGER PRIMARY KEY,
+        "MessageId" INTEGER NOT NULL REFERENCES "Message" ("messageId") ON DELETE CASCADE,
+        "email" VARCHAR NOT NULL,
+        "sent" BOOLEAN NOT NULL,
+        "sendAttemptTime" DATETIME)''',
+    '''INSERT INTO "Message" ("messageId", "userId", "message", "sendTime", "sent")
+        VALUES (1, 'test-user', 'test', '2021-10-27 23:22:19', 0)''',
+    '''INSERT INTO "EmailMessageRecipient" ("messageSendRequestId", "MessageId", "email", "sent")
+        VALUES (1, 1, 'test@email.com', 0)''',
+]
+
+class TestSchema(unittest.TestCase):
+    '''
+    Schema upgrade unittest
+    '''
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['TESTING'] = True
+        db.init_app(self.app)
+        with self.app.app_context():
+            for statement in OLD_SCHEMA:
+                db.engine.execute(statement)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def columns(self, table):
+        return {column['name'] for column in sqlalchemy.inspect(db.engine).get_columns(table)}
+
+    def test_upgrade_adds_the_missing_columns(self):
+        with self.app.app_context():
+            upgrade_schema()
+            for table in db.metadata.sorted_tables:
+                self.assertLessEqual({column.name for column in table.columns},
+                    self.columns(table.name))
+                self.assertLessEqual({index.name for index in table.indexes},
+                    {index['name'] for index in sqlalchemy.inspect(db.engine)
+                        .get_indexes(table.name)})
+
+            message = Message.query.get(1)
+            self.assertIsNone(message.claimed_by)
+            self.assertEqual([(recipient.email, recipient.attempt_count)
+                    for recipient in message.email_recipients],
+                [('test@email.com', 0)])
+
+    def test_upgrade_is_idempotent(self):
+        with self.app.app_context():
+            upgrade_schema()
+            upgrade_schema()
+            self.assertIn('claimedBy', self.columns('Message'))
+            self.assertIn('attemptCount', self.columns('EmailMessageRecipient'))
+
+    def test_upgrade_is_serialized_on_postgres(self):
+        connection = MagicMock()
+        connection.dialect.name = 'postgresql'
+        with self.app.app_context(), patch.object(db, 'get_engine') as get_engine, \
+                patch.object(db.metadata, 'create_all') as create_all:
+            get_engine.return_value.begin.return_value.__enter__.return_value = connection
+            upgrade_schema()
+
+        # the lock is taken first, in the transaction of the whole upgrade
+        statement, parameters = connection.execute.call_args_list[0].args
+        self.assertEqual(str(statement), 'SELECT pg_advisory_xact_lock(:key)')
+        self.assertEqual(parameters, {'key': SCHEMA_LOCK_KEY})
+        create_all.assert_called_once_with(bind=connection)
+        self.assertTrue(all('IF NOT EXISTS' in str(call.args[0])
+            for call in connection.execute.call_args_list[1:]))
@@ -0,0 +1,66 @@
+'''
+    CircuitBreaker unittest
+'''
+import smtplib
+import unittest
+from services.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, \
+    CircuitOpenError, is_connection_failure
+from services.metrics import Metrics
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    '''
+    CircuitBreaker unittest
+    '''
+    def setUp(self):
+        self.now = 0.0
+        self.metrics = Metrics()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10,
+            clock=lambda: self.now, metrics=self.metrics)
+
+    def test_is_connection_failure(self):
+        self.assertTrue(is_connection_failure(ConnectionRefusedError()))
+        self.assertTrue(is_connection_failure(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_connection_failure(smtplib.SMTPConnectError(421, b'Busy')))
+        self.assertFalse(is_connection_failure(smtplib.SMTPDataError(554, b'Rejected')))
+        self.assertFalse(is_connection_failure(smtplib.SMTPRecipientsRefused({})))
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_send()
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.metrics.get('mibs_smtp_circuit_trips_total'), 1)
+        self.now = 4.0
+        self.assertEqual(self.breaker.seconds_until_probe(), 6.0)
+        with self.assertRaises(CircuitOpenError) as context:
+            self.breaker.before_send()
+        self.assertEqual(context.exception.retry_after, 6.0)
+
+    def test_half_open_probe(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now = 10.0
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertEqual(self.breaker.seconds_until_probe(), 0.0)
+        self.breaker.before_send()
+        # only one probe at a time
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_send()
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.now = 20.0
+        self.breaker.before_send()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.metrics.get('mibs_smtp_circuit_state'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
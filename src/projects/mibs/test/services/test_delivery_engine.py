@@ -0,0 +1,206 @@
+'''
+    DeliveryEngine unittest
+'''
+import smtplib
+import threading
+import time
+import unittest
+from collections import defaultdict, namedtuple
+from services.delivery_engine import DeliveryEngine, DeliveryJob, email_domain
+from services.metrics import Metrics
+from services.rate_limiter import Limit, RateLimiter
+
+Recipient = namedtuple('Recipient', ['message_send_request_id', 'email'])
+
+class TestDeliveryEngine(unittest.TestCase):
+    '''
+    DeliveryEngine unittest
+    '''
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.running_by_domain = defaultdict(int)
+        self.max_running_by_domain = defaultdict(int)
+        self.transactions = []
+
+    def send(self, message_id, message, emails):
+        del message_id, message
+        self.transactions.append(emails)
+        domains = {email_domain(email) for email in emails}
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            for domain in domains:
+                self.running_by_domain[domain] += 1
+                self.max_running_by_domain[domain] = max(self.max_running_by_domain[domain],
+                    self.running_by_domain[domain])
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+            for domain in domains:
+                self.running_by_domain[domain] -= 1
+        if any(email.startswith('error') for email in emails):
+            raise smtplib.SMTPDataError(554, b'Transaction failed')
+        refused = {email: (550, b'No such user') for email in emails if email.startswith('fail')}
+        if len(refused) == len(emails):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        return refused
+
+    def test_email_domain(self):
+        self.assertEqual(email_domain('Test@Email.com'), 'email.com')
+
+    def test_deliver_defers_recipients_over_rate_limit(self):
+        jobs = [DeliveryJob(i, f'message {i}', [
+                Recipient(i * 10 + j, f'user{j}@domain.com') for j in range(3)])
+            for i in range(2)]
+        rate_limiter = RateLimiter(Limit(1, 4), Limit(0, 1), config_file=None,
+            clock=lambda: 0.0, metrics=Metrics())
+        engine = DeliveryEngine(self.send, recipients_per_transaction=3,
+            rate_limiter=rate_limiter)
+        try:
+            results = engine.deliver(jobs)
+        finally:
+            engine.shutdown()
+
+        self.assertEqual(len(results), 6)
+        self.assertEqual(sum(result.sent for result in results), 4)
+        deferred = [result for result in results if not result.sent]
+        self.assertEqual(len(deferred), 2)
+        for result in deferred:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.retry_after, 2.0)
+
+    def test_drain_defers_queued_and_abandons_running_transactions(self):
+        jobs = [DeliveryJob(i, f'message {i}', [Recipient(i, f'user{i}@domain.com')])
+            for i in range(3)]
+        engine = DeliveryEngine(lambda message_id, message, emails: time.sleep(2) or {},
+            domain_concurrency=1)
+        threading.Timer(0.05, lambda: engine.drain(time.monotonic() + 0.05)).start()
+        try:
+            started = time.monotonic()
+            results = engine.deliver(jobs)
+            # the deadline is checked at least every HEARTBEAT_POLL_INTERVAL
+            self.assertLess(time.monotonic() - started, 1.5)
+        finally:
+            engine.shutdown()
+
+        # the first transaction was running at the deadline, so its outcome is unknown
+        self.assertEqual([result.message_id for result in results], [1, 2])
+        for result in results:
+            self.assertFalse(result.sent)
+            self.assertEqual(result.retry_after, 0.0)
+
+    def test_deliver_interleaves_users(self):
+        jobs = [DeliveryJob(1, 'fan-out', [Recipient(j, f'user{j}@domain.com')
+                for j in range(6)], 'heavy-user'),
+            DeliveryJob(2, 'message', [Recipient(10, 'someone@domain.com')], 'light-user'),
+            DeliveryJob(3, 'message', [Recipient(11, 'other@domain.com')], 'light-user')]
+        engine = DeliveryEngine(self.send, domain_concurrency=1, recipients_per_transaction=2)
+        try:
+            engine.deliver(jobs)
+        finally:
+            engine.shutdown()
+
+        # light-user's two single recipient transactions fit in one round of its deficit
+        self.assertEqual(self.transactions, [['user0@domain.com', 'user1@domain.com'],
+            ['someone@domain.com'], ['other@domain.com'], ['user2@domain.com', 'user3@domain.com'],
+            ['user4@domain.com', 'user5@domain.com']])
+
+    def test_deliver_respects_concurrency_limits(self):
+        jobs = [DeliveryJob(i, f'message {i}', [
+                Recipient(i * 10 + j, f'user{j}@domain{j % 2}.com') for j in range(6)])
+            for i in range(5)]
+        engine = DeliveryEngine(self.send, concurrency=3, domain_concurrency=2,
+            recipients_per_transaction=1)
+        try:
+            results = engine.deliver(jobs)
+        finally:
+            engine.shutdown()
+
+        self.assertEqual(len(results), 30)
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual({result.message_send_request_id for result in results},
+            {recipient.message_send_request_id for job in jobs for recipient in job.recipients})
+        self.assertLessEqual(self.max_running, 3)
+        for domain_max in self.max_running_by_domain.values():
+            self.assertLessEqual(domain_max, 2)
+
+    def test_deliver_batches_recipients_per_message(self):
+        jobs = [DeliveryJob(1, 'message', [Recipient(j, f'user{j}@domain{j % 2}.com')
+            for j in range(7)])]
+        engine = DeliveryEngine(self.send, recipients_per_transaction=2)
+        try:
+            results = engine.deliver(jobs)
+        finally:
+            engine.shutdown()
+
+        self.assertEqual(len(results), 7)
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(sorted(len(emails) for emails in self.transactions), [1, 2, 2, 2])
+
+    def test_deliver_sends_a_message_to_mixed_domains_in_one_transaction(self):
+        jobs = [DeliveryJob(1, 'message', [Recipient(j, f'user{j}@domain{j % 3}.com')
+                for j in range(6)]),
+            DeliveryJob(2, 'message', [Recipient(10, 'user@domain0.com')])]
+        engine = DeliveryEngine(self.send, domain_concurrency=1)
+        try:
+            results = engine.deliver(jobs)
+        finally:
+            engine.shutdown()
+
+        self.assertEqual(len(results), 7)
+        self.assertTrue(all(result.sent for result in results))
+        self.assertEqual(self.transactions, [[f'user{j}@domain{j % 3}.com' for j in range(6)],
+            ['user@domain0.com']])
+        # both transactions have a domain0.com recipient, so they did not run at once
+        self.assertEqual(self.max_running_by_domain['domain0.com'], 1)
+
+    def test_deliver_rate_limits_every_domain_of_a_transaction(self):
+        jobs = [DeliveryJob(1, 'message', [Recipient(j, f'user{j}@domain{j % 2}.com')
+            for j in range(4)])]
+        rate_limiter = RateLimiter(Limit(0, 1), Limit(0, 1), config_file=None,
+            domain_limits={'domain1.com': Limit(1, 1)}, clock=lambda: 0.0, metrics=Metrics())
+        engine = DeliveryEngine(self.send, rate_limiter=rate_limiter)
+        try:
+            results = engine.deliver(jobs)
+        finally:
+            engine.shutdown()
+
+        self.assertEqual(self.transactions, [['user0@domain0.com', 'user2@domain0.com',
+            'user1@domain1.com']])
+        deferred = [result for result in results if not result.sent]
+        self.assertEqual([result.email for result in deferred], ['user3@domain1.com'])
+        self.assertEqual(deferred[0].retry_after, 1.0)
+
+    def test_deliver_reports_failures(self):
+        heartbeat_calls = []
+        jobs = [
+            DeliveryJob(1, 'message', [Recipient(1, 'ok@email.com'),
+                Recipient(2, 'fail@email.com')]),
+            DeliveryJob(2, 'message', [Recipient(3, 'fail@email.com')]),
+            DeliveryJob(3, 'message', [Recipient(4, 'ok@email.com'),
+                Recipient(5, 'error@email.com')]),
+        ]
+        engine = DeliveryEngine(self.send)
+        try:
+            results = engine.deliver(jobs, heartbeat=lambda: heartbeat_calls.append(1))
+        finally:
+            engine.shutdown()
+
+        results_by_id = {result.message_send_request_id: result for result in results}
+        self.assertTrue(results_by_id[1].sent)
+        self.assertIsNone(results_by_id[1].error)
+        for refused_id in [2, 3]:
+            self.assertFalse(results_by_id[refused_id].sent)
+            self.assertEqual(results_by_id[refused_id].smtp_code, 550)
+            self.assertIsInstance(results_by_id[refused_id].error,
+                smtplib.SMTPRecipientsRefused)
+        for failed_id in [4, 5]:
+            self.assertFalse(results_by_id[failed_id].sent)
+            self.assertEqual(results_by_id[failed_id].smtp_code, 554)
+            self.assertIsInstance(results_by_id[failed_id].error, smtplib.SMTPDataError)
+        self.assertGreater(len(heartbeat_calls), 0)
+
+if __name__ == '__main__':
+    unittest.main()
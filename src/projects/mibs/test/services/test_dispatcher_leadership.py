@@ -0,0 +1,50 @@
+'''
+    DispatcherLeadership unittest
+'''
+import unittest
+from unittest.mock import MagicMock
+from services.dispatcher_leadership import DispatcherLeadership
+
+class TestDispatcherLeadership(unittest.TestCase):
+    '''
+    DispatcherLeadership unittest
+    '''
+    def create_engine(self, dialect, locked_keys=()):
+        engine = MagicMock()
+        engine.dialect.name = dialect
+        cursor = engine.raw_connection.return_value.connection.cursor.return_value.__enter__ \
+            .return_value
+        def execute(statement, parameters=None):
+            del statement
+            if parameters is not None:
+                cursor.fetchone.return_value = (parameters[0] not in locked_keys,)
+        cursor.execute.side_effect = execute
+        return engine
+
+    def test_non_postgres_always_holds_a_slot(self):
+        leadership = DispatcherLeadership(self.create_engine('sqlite'))
+        self.assertTrue(leadership.try_acquire())
+        self.assertTrue(leadership.is_held())
+        self.assertEqual(leadership.slot, 0)
+
+    def test_acquires_first_free_slot(self):
+        engine = self.create_engine('postgresql', locked_keys=(100,))
+        leadership = DispatcherLeadership(engine, slots=2, lock_key=100)
+        self.assertTrue(leadership.try_acquire())
+        self.assertEqual(leadership.slot, 1)
+        self.assertTrue(leadership.is_held())
+
+        leadership.release()
+        self.assertIsNone(leadership.slot)
+        self.assertFalse(leadership.is_held())
+        engine.raw_connection.return_value.invalidate.assert_called_once()
+
+    def test_standby_when_all_slots_are_taken(self):
+        engine = self.create_engine('postgresql', locked_keys=(100, 101))
+        leadership = DispatcherLeadership(engine, slots=2, lock_key=100)
+        self.assertFalse(leadership.try_acquire())
+        self.assertIsNone(leadership.slot)
+        engine.raw_connection.return_value.invalidate.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+'''
+    DueQueue unittest
+'''
+import unittest
+from datetime import datetime, timedelta
+from services.due_queue import DueQueue
+
+NOW = datetime(2021, 10, 27, 23, 22, 19)
+
+class TestDueQueue(unittest.TestCase):
+    '''
+    DueQueue unittest
+    '''
+    def setUp(self):
+        self.due_queue = DueQueue()
+
+    def test_empty_queue_has_no_deadline(self):
+        self.assertIsNone(self.due_queue.next_deadline())
+        self.assertEqual(self.due_queue.pop_due(NOW), [])
+
+    def test_next_deadline_is_earliest(self):
+        self.due_queue.push(1, NOW + timedelta(minutes=5))
+        self.due_queue.push(2, NOW + timedelta(minutes=1))
+        self.due_queue.push(3, NOW + timedelta(minutes=3))
+        self.assertEqual(self.due_queue.next_deadline(), NOW + timedelta(minutes=1))
+
+    def test_pop_due_only_returns_due_messages(self):
+        self.due_queue.push(1, NOW - timedelta(seconds=1))
+        self.due_queue.push(2, NOW)
+        self.due_queue.push(3, NOW + timedelta(seconds=1))
+        self.assertEqual(self.due_queue.pop_due(NOW), [1, 2])
+        self.assertEqual(len(self.due_queue), 1)
+        self.assertEqual(self.due_queue.next_deadline(), NOW + timedelta(seconds=1))
+
+    def test_push_replaces_previous_deadline(self):
+        self.due_queue.push(1, NOW - timedelta(minutes=1))
+        self.due_queue.push(1, NOW + timedelta(minutes=1))
+        self.assertEqual(self.due_queue.pop_due(NOW), [])
+        self.assertEqual(self.due_queue.next_deadline(), NOW + timedelta(minutes=1))
+        self.assertEqual(len(self.due_queue), 1)
+
+    def test_repeated_pushes_do_not_grow_the_heap(self):
+        for _ in range(200):
+            for message_id in range(100):
+                self.due_queue.push(message_id, NOW + timedelta(seconds=message_id))
+        self.assertEqual(len(self.due_queue), 100)
+        self.assertEqual(len(self.due_queue._heap), 100) # pylint: disable=W0212
+
+    def test_replaced_deadlines_do_not_grow_the_heap(self):
+        for attempt in range(200):
+            for message_id in range(100):
+                self.due_queue.push(message_id, NOW + timedelta(seconds=message_id + attempt))
+        self.assertLessEqual(len(self.due_queue._heap), 200) # pylint: disable=W0212
+        self.assertEqual(self.due_queue.pop_due(NOW + timedelta(seconds=199)), [0])
+
+if __name__ == '__main__':
+    unittest.main()
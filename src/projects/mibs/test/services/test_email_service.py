@@ -2,11 +2,19 @@
     Mibs polling Service unittest
 '''
 import unittest
+import sqlalchemy
+from unittest.mock import MagicMock, patch
 from api.mibs import mibs_blueprint
-from models import Message, EmailMessageRecipient, db
+from models import Message, EmailMessageRecipient, DeadLetterRecipient, db
 from lib.logger.safezone_logger import get_logger
 from flask import Flask
 from services.message_pool_service import MessagePoolingService
+from services.delivery_engine import DeliveryJob, DeliveryResult
+from services.message_leases import MessageLeaseManager, LEASE_DURATION
+from services.retry_policy import MAX_SEND_ATTEMPTS, RETRY_MAX_DELAY
+from services.dead_letters import replay_dead_letters
+from services.rate_limiter import Limit
+from services.priority_lanes import CATCH_UP, DUE_NOW, RETRY, Lane
 from datetime import timedelta, datetime
 
 LOGGER = get_logger(__name__)
@@ -51,15 +59,466 @@ class TestEmailService(unittest.TestCase):
 
     def test__update_recipients_send_attempt_time(self):
         with self.app.app_context():
-            email_recipients_preupdate = EmailMessageRecipient.query.all()
+            recipient_ids = [recipient.message_send_request_id
+                for recipient in EmailMessageRecipient.query.all()]
             message_pool_service = MessagePoolingService()
             # pylint: disable=W0212
-            message_pool_service._update_recipients_send_attempt_time(email_recipients_preupdate)
+            message_pool_service._update_recipients_send_attempt_time(recipient_ids)
             email_recipients_postupdate =  EmailMessageRecipient.query.all()
             for recipient in email_recipients_postupdate:
                 self.assertNotEqual(recipient.send_attempt_time, self.last_week)
                 # pylint: disable=W0212
                 self.assertEqual(recipient.send_attempt_time, message_pool_service._current_time)
 
+    def test__get_email_recipients(self):
+        with self.app.app_context():
+            message_ids = [message.message_id for message in Message.query.all()]
+            # pylint: disable=W0212
+            recipients_by_message_id = MessagePoolingService._get_email_recipients(message_ids)
+
+            self.assertEqual(set(recipients_by_message_id), set(message_ids))
+            for message in Message.query.all():
+                self.assertEqual(
+                    [recipient.email for recipient in recipients_by_message_id[message.message_id]],
+                    [recipient.email for recipient in message.email_recipients])
+
+    def test__dispatch_due_messages(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = MagicMock(return_value={})
+            message_pool_service._dispatch_due_messages()
+
+            # the 3 recipients of each message are sent in one transaction
+            self.assertEqual(message_pool_service._email_service._send_transaction.call_count, 4)
+            for message in Message.query.all():
+                self.assertTrue(message.sent)
+                self.assertIsNone(message.claimed_by)
+                for recipient in message.email_recipients:
+                    self.assertTrue(recipient.sent)
+                    self.assertIsNotNone(recipient.send_attempt_time)
+
+    def test_no_transaction_is_open_while_sending(self):
+        with self.app.app_context():
+            in_transaction = []
+            # sends run on delivery threads, so check the session of the dispatching thread
+            session = db.session()
+            def send_transaction(*_args):
+                in_transaction.append(session.in_transaction())
+                return {}
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = \
+                MagicMock(side_effect=send_transaction)
+            message_pool_service._dispatch_due_messages()
+
+            self.assertEqual(in_transaction, [False] * 4)
+            self.assertFalse(db.session().in_transaction())
+
+    def test__dispatch_due_messages_with_failed_recipient(self):
+        failed_email = f'recipient1.testuser2{TEST_EMAIL_DOMAIN}'
+        def send_transaction(message_id, message, emails):
+            del message_id, message
+            if failed_email in emails:
+                return {failed_email: (451, b'Try again later')}
+            return {}
+
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = \
+                MagicMock(side_effect=send_transaction)
+            message_pool_service._dispatch_due_messages()
+
+            for message in Message.query.all():
+                failed = any(r.email == failed_email for r in message.email_recipients)
+                self.assertEqual(message.sent, not failed)
+                self.assertIsNone(message.claimed_by)
+                for recipient in message.email_recipients:
+                    self.assertEqual(recipient.sent, recipient.email != failed_email)
+                    if recipient.email == failed_email:
+                        self.assertEqual(recipient.attempt_count, 1)
+                        self.assertGreater(recipient.next_attempt_at, self.last_week)
+
+    def test_failed_recipient_is_retried_alone_when_due(self):
+        failed_email = f'recipient1.testuser2{TEST_EMAIL_DOMAIN}'
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            send_transaction = message_pool_service._email_service._send_transaction = \
+                MagicMock(side_effect=lambda message_id, message, emails:
+                    {failed_email: (451, b'Try again later')} if failed_email in emails else {})
+            message_pool_service._dispatch_due_messages()
+
+            # the retry is not due yet, so nothing is claimed
+            send_transaction.reset_mock()
+            message_pool_service._dispatch_due_messages()
+            send_transaction.assert_not_called()
+
+            EmailMessageRecipient.query.filter_by(email=failed_email) \
+                .update({EmailMessageRecipient.next_attempt_at: self.last_week})
+            db.session.commit()
+            send_transaction.side_effect = None
+            send_transaction.return_value = {}
+            message_pool_service._dispatch_due_messages()
+
+            send_transaction.assert_called_once()
+            self.assertEqual(send_transaction.call_args[0][2], [failed_email])
+            for message in Message.query.all():
+                self.assertTrue(message.sent)
+            self.assertEqual(
+                EmailMessageRecipient.query.filter_by(email=failed_email).one().attempt_count, 1)
+
+    def test_rate_limited_recipients_are_deferred(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = MagicMock(return_value={})
+            message_pool_service._email_service.rate_limiter.configure(Limit(0.01, 6))
+            message_pool_service._dispatch_due_messages()
+
+            self.assertEqual(EmailMessageRecipient.query.filter_by(sent=True).count(), 6)
+            deferred = EmailMessageRecipient.query.filter_by(sent=False).all()
+            self.assertEqual(len(deferred), 6)
+            for recipient in deferred:
+                self.assertEqual(recipient.attempt_count, 0)
+                self.assertGreater(recipient.next_attempt_at, datetime.utcnow())
+
+    def test_dispatch_stops_while_relay_is_down(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            email_service = message_pool_service._email_service
+            email_service.transport.send = MagicMock(
+                side_effect=ConnectionRefusedError('Connection refused'))
+            email_service.circuit_breaker._failure_threshold = 2
+            message_pool_service._dispatch_due_messages()
+
+            self.assertEqual(email_service.transport.send.call_count, 2)
+            self.assertEqual(Message.query.filter(Message.last_sent_time.isnot(None)).count(), 4)
+            for recipient in EmailMessageRecipient.query.all():
+                self.assertFalse(recipient.sent)
+            # the recipients that were not attempted do not count as failed
+            self.assertEqual(EmailMessageRecipient.query.filter(
+                EmailMessageRecipient.attempt_count > 0).count(), 6)
+
+            email_service.transport.send.reset_mock()
+            message_pool_service._dispatch_due_messages()
+            email_service.transport.send.assert_not_called()
+
+    def test_permanent_failure_is_dead_lettered(self):
+        failed_email = f'recipient1.testuser2{TEST_EMAIL_DOMAIN}'
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = MagicMock(
+                side_effect=lambda message_id, message, emails:
+                    {failed_email: (550, b'No such user')} if failed_email in emails else {})
+            message_pool_service._dispatch_due_messages()
+
+            dead_letter = DeadLetterRecipient.query.one()
+            self.assertEqual(dead_letter.email, failed_email)
+            self.assertEqual(dead_letter.attempt_count, 1)
+            self.assertEqual(dead_letter.smtp_code, 550)
+            self.assertIn('No such user', dead_letter.last_error)
+            self.assertEqual(EmailMessageRecipient.query.filter_by(email=failed_email).count(), 0)
+            # the dead lettered message was not delivered, so it is not reported as sent
+            for message in Message.query.all():
+                self.assertEqual(message.sent, message.message_id != dead_letter.message_id)
+                self.assertIsNone(message.claimed_by)
+
+    def test_message_deleted_while_sending_is_not_dead_lettered(self):
+        failed_email = f'recipient1.testuser2{TEST_EMAIL_DOMAIN}'
+        with self.app.app_context():
+            engine = db.engine
+            def send_transaction(message_id, message, emails):
+                del message
+                if failed_email not in emails:
+                    return {}
+                # the user deletes the mib while its recipients are being sent
+                engine.execute(f'DELETE FROM "Message" WHERE "messageId" = {message_id}')
+                return {failed_email: (550, b'No such user')}
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = \
+                MagicMock(side_effect=send_transaction)
+            message_pool_service._dispatch_due_messages()
+
+            self.assertEqual(DeadLetterRecipient.query.count(), 0)
+            self.assertEqual(Message.query.count(), 3)
+            for message in Message.query.all():
+                self.assertTrue(message.sent)
+            self.assertEqual(message_pool_service._leases.held, set())
+
+    def test_failed_round_does_not_stop_the_dispatcher(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = MagicMock(return_value={})
+            with patch.object(message_pool_service, '_record_delivery_results',
+                    side_effect=sqlalchemy.exc.OperationalError('UPDATE', {}, Exception())):
+                message_pool_service._dispatch_due_messages()
+
+            self.assertEqual(message_pool_service._leases.held, set())
+            self.assertFalse(db.session().in_transaction())
+            for message in Message.query.all():
+                self.assertFalse(message.sent)
+                self.assertIsNotNone(message.claimed_by)
+
+            # the mibs are claimed again once their leases expire
+            Message.query.update({Message.lease_expires_at: datetime.utcnow()})
+            db.session.commit()
+            message_pool_service._dispatch_due_messages()
+            for message in Message.query.all():
+                self.assertTrue(message.sent)
+
+    def test_recipient_is_dead_lettered_after_max_attempts(self):
+        failed_email = f'recipient1.testuser2{TEST_EMAIL_DOMAIN}'
+        with self.app.app_context():
+            EmailMessageRecipient.query.filter_by(email=failed_email) \
+                .update({EmailMessageRecipient.attempt_count: MAX_SEND_ATTEMPTS - 1})
+            db.session.commit()
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = MagicMock(
+                side_effect=lambda message_id, message, emails:
+                    {failed_email: (451, b'Try again later')} if failed_email in emails else {})
+            message_pool_service._dispatch_due_messages()
+
+            self.assertEqual(DeadLetterRecipient.query.one().attempt_count, MAX_SEND_ATTEMPTS)
+            self.assertEqual(EmailMessageRecipient.query.filter_by(email=failed_email).count(), 0)
+
+    def test_replay_dead_letters(self):
+        failed_email = f'recipient1.testuser2{TEST_EMAIL_DOMAIN}'
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            send_transaction = message_pool_service._email_service._send_transaction = \
+                MagicMock(side_effect=lambda message_id, message, emails:
+                    {failed_email: (550, b'No such user')} if failed_email in emails else {})
+            message_pool_service._dispatch_due_messages()
+            message_id = DeadLetterRecipient.query.one().message_id
+
+            self.assertEqual(replay_dead_letters(batch_size=1), 1)
+            self.assertEqual(DeadLetterRecipient.query.count(), 0)
+            self.assertFalse(Message.query.get(message_id).sent)
+            replayed = EmailMessageRecipient.query.filter_by(email=failed_email).one()
+            self.assertEqual(replayed.attempt_count, 0)
+            self.assertIsNone(replayed.next_attempt_at)
+
+            send_transaction.side_effect = None
+            send_transaction.return_value = {}
+            send_transaction.reset_mock()
+            message_pool_service._dispatch_due_messages()
+            send_transaction.assert_called_once()
+            self.assertTrue(Message.query.get(message_id).sent)
+
+    def test_load_upcoming_deadlines_uses_next_attempt(self):
+        with self.app.app_context():
+            next_attempt = datetime.utcnow() + timedelta(seconds=30)
+            EmailMessageRecipient.query.update(
+                {EmailMessageRecipient.next_attempt_at: next_attempt})
+            first_message = Message.query.first()
+            first_message.email_recipients[0].next_attempt_at = None
+            db.session.commit()
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._load_upcoming_deadlines(datetime.utcnow())
+
+            self.assertEqual(len(message_pool_service._due_queue), 4)
+            self.assertEqual(message_pool_service._due_queue.next_deadline(), self.last_week)
+            self.assertEqual(message_pool_service._due_queue.pop_due(datetime.utcnow()),
+                [first_message.message_id])
+            self.assertEqual(message_pool_service._due_queue.next_deadline(), next_attempt)
+
+    def test_cancel_stops_claiming(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            message_pool_service._email_service._send_transaction = MagicMock(return_value={})
+            message_pool_service.cancel()
+            message_pool_service._dispatch_due_messages()
+
+            message_pool_service._email_service._send_transaction.assert_not_called()
+            self.assertEqual(Message.query.filter(Message.claimed_by.isnot(None)).count(), 0)
+
+    def test_abandoned_transactions_keep_their_lease(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            claimed, _ = message_pool_service._claim_lanes(2)
+            recipients = message_pool_service._get_email_recipients([mib[0] for mib in claimed])
+            jobs = [DeliveryJob(message_id, message, recipients[message_id])
+                for message_id, message, _, _ in claimed]
+            # the transaction of the first message was still running at the drain deadline
+            results = [DeliveryResult(jobs[1].message_id, recipient.message_send_request_id,
+                    recipient.email, True)
+                for recipient in jobs[1].recipients]
+            message_pool_service._record_delivery_results(jobs, results)
+
+            abandoned = Message.query.get(jobs[0].message_id)
+            self.assertFalse(abandoned.sent)
+            self.assertIsNotNone(abandoned.claimed_by)
+            self.assertTrue(Message.query.get(jobs[1].message_id).sent)
+            self.assertEqual(message_pool_service._leases.held, {jobs[0].message_id})
+
+    def test_delivery_results_are_written_in_one_update(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            claimed, _ = message_pool_service._claim_lanes(1)
+            recipients = message_pool_service._get_email_recipients([mib[0] for mib in claimed])
+            job = DeliveryJob(claimed[0][0], claimed[0][1], recipients[claimed[0][0]])
+            sent, retried, deferred = job.recipients
+            results = [
+                DeliveryResult(job.message_id, sent.message_send_request_id, sent.email, True),
+                DeliveryResult(job.message_id, retried.message_send_request_id, retried.email,
+                    False, Exception('Try again later'), 451),
+                DeliveryResult(job.message_id, deferred.message_send_request_id, deferred.email,
+                    False, retry_after=60.0),
+            ]
+            statements = []
+            def record_statement(statement, executemany, **_kwargs):
+                if statement.startswith('UPDATE "EmailMessageRecipient"'):
+                    statements.append(executemany)
+            sqlalchemy.event.listen(db.engine, 'before_cursor_execute', record_statement,
+                named=True)
+            try:
+                message_pool_service._record_delivery_results([job], results)
+            finally:
+                sqlalchemy.event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+            self.assertEqual(statements, [True])
+            by_id = {recipient.message_send_request_id: recipient
+                for recipient in EmailMessageRecipient.query.all()}
+            self.assertTrue(by_id[sent.message_send_request_id].sent)
+            self.assertIsNone(by_id[sent.message_send_request_id].next_attempt_at)
+            self.assertFalse(by_id[retried.message_send_request_id].sent)
+            self.assertEqual(by_id[retried.message_send_request_id].attempt_count, 1)
+            self.assertFalse(by_id[deferred.message_send_request_id].sent)
+            self.assertEqual(by_id[deferred.message_send_request_id].attempt_count, 0)
+            self.assertGreater(by_id[deferred.message_send_request_id].next_attempt_at,
+                datetime.utcnow())
+
+    def test__get_email_recipients_limit_per_message(self):
+        with self.app.app_context():
+            message_ids = [message.message_id for message in Message.query.all()]
+            # pylint: disable=W0212
+            recipients_by_message_id = MessagePoolingService._get_email_recipients(message_ids,
+                limit_per_message=2)
+
+            for message in Message.query.all():
+                self.assertEqual(
+                    [recipient.email for recipient in recipients_by_message_id[message.message_id]],
+                    [recipient.email for recipient in message.email_recipients[:2]])
+
+    def test_claim_is_round_robin_across_users(self):
+        with self.app.app_context():
+            for i in range(3):
+                db.session.add(Message(user_id='other-user', message=f'Other message {i}',
+                    send_time=datetime.utcnow(),
+                    email_recipients=[EmailMessageRecipient(email=f'other{i}@email.com')]))
+            db.session.commit()
+            claimed = MessageLeaseManager('worker').claim(4, datetime.utcnow())
+
+            # the older backlog of the first user does not hold up the other user
+            self.assertEqual([mib[3] for mib in claimed],
+                [TEMP_USER_ID, 'other-user', TEMP_USER_ID, 'other-user'])
+
+    def test_due_now_lane_is_not_starved_by_backlog(self):
+        with self.app.app_context():
+            fresh_message = Message(user_id='other-user', message='Fresh message',
+                send_time=datetime.utcnow(),
+                email_recipients=[EmailMessageRecipient(email='fresh@email.com')])
+            db.session.add(fresh_message)
+            db.session.commit()
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            claimed, lanes_have_more = message_pool_service._claim_lanes(1)
+            self.assertEqual([mib[0] for mib in claimed], [fresh_message.message_id])
+            self.assertTrue(lanes_have_more)
+
+            claimed, lanes_have_more = message_pool_service._claim_lanes(10)
+            self.assertEqual(len(claimed), 4)
+            self.assertFalse(lanes_have_more)
+
+    def test_lanes_that_cannot_claim_are_exhausted(self):
+        lanes = [Lane(DUE_NOW, 0.5, 100), Lane(RETRY, 0, 0), Lane(CATCH_UP, 0.3, 100)]
+        with self.app.app_context(), patch('services.message_pool_service.LANES', lanes):
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            self.assertEqual(message_pool_service._claim_lanes(0), ([], False))
+
+            claimed, lanes_have_more = message_pool_service._claim_lanes(10)
+            self.assertEqual(len(claimed), 4)
+            self.assertFalse(lanes_have_more)
+            self.assertEqual(message_pool_service._claim_lanes(10), ([], False))
+
+    def test_claim_lanes_is_bounded(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            # pylint: disable=W0212
+            first_claim, _ = message_pool_service._claim_lanes(3)
+            second_claim, _ = message_pool_service._claim_lanes(3)
+            third_claim, _ = message_pool_service._claim_lanes(3)
+
+            self.assertEqual(len(first_claim), 3)
+            self.assertEqual(len(second_claim), 1)
+            self.assertEqual(third_claim, [])
+            claimed_ids = {mib[0] for mib in first_claim + second_claim}
+            self.assertEqual(claimed_ids, {mib.message_id for mib in Message.query.all()})
+            for message in Message.query.all():
+                self.assertIsNotNone(message.last_sent_time)
+                self.assertIsNotNone(message.lease_expires_at)
+                self.assertEqual(message.claimed_by, message_pool_service._leases.worker_id)
+
+    def test_expired_lease_is_reclaimed(self):
+        with self.app.app_context():
+            message_pool_service = MessagePoolingService()
+            claimed, _ = message_pool_service._claim_lanes(10) # pylint: disable=W0212
+            self.assertEqual(len(claimed), 4)
+
+            other_worker = MessageLeaseManager('other-worker')
+            self.assertEqual(other_worker.claim(10, datetime.utcnow()), [])
+            reclaimed = other_worker.claim(10, datetime.utcnow() + LEASE_DURATION)
+            self.assertEqual(len(reclaimed), 4)
+            for message in Message.query.all():
+                self.assertEqual(message.claimed_by, 'other-worker')
+
+    def test_heartbeat_extends_lease(self):
+        with self.app.app_context():
+            leases = MessageLeaseManager('worker')
+            leases.claim(10, self.last_week)
+            leases.claim(10, datetime.utcnow())
+            leases.heartbeat(force=True)
+
+            self.assertEqual(len(leases.held), 4)
+            for message in Message.query.all():
+                self.assertGreater(message.lease_expires_at, datetime.utcnow())
+
+    def test_release(self):
+        with self.app.app_context():
+            leases = MessageLeaseManager('worker')
+            claimed_ids = [mib[0] for mib in leases.claim(10, datetime.utcnow())]
+            leases.release(claimed_ids[:2], sent=True)
+            leases.release(claimed_ids[2:], sent=False)
+            db.session.commit()
+
+            self.assertEqual(leases.held, set())
+            for message in Message.query.all():
+                self.assertIsNone(message.claimed_by)
+                self.assertEqual(message.sent, message.message_id in claimed_ids[:2])
+            self.assertEqual(len(leases.claim(10, datetime.utcnow())), 2)
+
+    def test_claim_skips_messages_without_due_recipients(self):
+        with self.app.app_context():
+            retry_time = datetime.utcnow() + RETRY_MAX_DELAY
+            EmailMessageRecipient.query.update({EmailMessageRecipient.next_attempt_at: retry_time})
+            db.session.commit()
+            leases = MessageLeaseManager('worker')
+
+            self.assertEqual(leases.claim(10, datetime.utcnow()), [])
+            self.assertEqual(len(leases.claim(10, retry_time)), 4)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,26 @@
+'''
+    Metrics unittest
+'''
+import unittest
+from services.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    '''
+    Metrics unittest
+    '''
+    def test_render(self):
+        metrics = Metrics()
+        metrics.increment('mibs_sent_total', 2, domain='a.com')
+        metrics.increment('mibs_sent_total', domain='a.com')
+        metrics.set_gauge('mibs_backlog', 5)
+
+        self.assertEqual(metrics.get('mibs_sent_total', domain='a.com'), 3)
+        self.assertIsNone(metrics.get('mibs_sent_total', domain='b.com'))
+        self.assertEqual(metrics.render(), '# TYPE mibs_sent_total counter\n'
+            'mibs_sent_total{domain="a.com"} 3\n'
+            '# TYPE mibs_backlog gauge\n'
+            'mibs_backlog 5\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+'''
+    Priority lanes unittest
+'''
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from services.metrics import Metrics
+from services.priority_lanes import CATCH_UP, DUE_NOW, RETRY, CatchUpProgress, Lane, \
+    lane_limits, _lane_from_env
+
+NOW = datetime(2021, 10, 27, 23, 22, 19)
+LANES = [Lane(DUE_NOW, 0.5, 100), Lane(RETRY, 0.2, 10), Lane(CATCH_UP, 0.3, 100)]
+
+class TestPriorityLanes(unittest.TestCase):
+    '''
+    Priority lanes unittest
+    '''
+    def test_lane_limits(self):
+        self.assertEqual(lane_limits(LANES, 100), [50, 10, 30])
+        self.assertEqual(lane_limits(LANES, 3), [1, 1, 1])
+        self.assertEqual(lane_limits(LANES, 1), [1, 0, 0])
+
+    def test_lane_batch_size_must_be_positive(self):
+        with patch.dict('os.environ', {'MIBS_LANE_CATCH_UP_BATCH_SIZE': '0'}):
+            with self.assertRaises(ValueError):
+                _lane_from_env(CATCH_UP, 0.3, 100)
+        with patch.dict('os.environ', {'MIBS_LANE_CATCH_UP_BATCH_SIZE': '20'}):
+            self.assertEqual(_lane_from_env(CATCH_UP, 0.3, 100), Lane(CATCH_UP, 0.3, 20))
+
+    def test_catch_up_eta(self):
+        metrics = Metrics()
+        progress = CatchUpProgress(smoothing=1, metrics=metrics)
+        progress.update(1000, NOW)
+        self.assertIsNone(progress.eta_seconds())
+        self.assertEqual(metrics.get('mibs_catch_up_eta_seconds'), -1)
+
+        progress.update(800, NOW + timedelta(seconds=10))
+        self.assertEqual(progress.eta_seconds(), 40)
+        self.assertEqual(metrics.get('mibs_catch_up_backlog'), 800)
+        self.assertEqual(metrics.get('mibs_catch_up_eta_seconds'), 40)
+
+        # the backlog grows faster than it is drained
+        progress.update(900, NOW + timedelta(seconds=20))
+        self.assertIsNone(progress.eta_seconds())
+
+        progress.update(0, NOW + timedelta(seconds=30))
+        self.assertEqual(progress.eta_seconds(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
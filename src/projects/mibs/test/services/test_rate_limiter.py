@@ -0,0 +1,75 @@
+'''
+    RateLimiter unittest
+'''
+import json
+import os
+import tempfile
+import unittest
+from services.metrics import Metrics
+from services.rate_limiter import Limit, RateLimiter, TokenBucket
+
+
+class TestRateLimiter(unittest.TestCase):
+    '''
+    RateLimiter unittest
+    '''
+    def setUp(self):
+        self.now = 0.0
+        self.metrics = Metrics()
+
+    def clock(self):
+        return self.now
+
+    def rate_limiter(self, limit, domain_limit, domain_limits=None, config_file=None):
+        return RateLimiter(limit, domain_limit, domain_limits=domain_limits,
+            config_file=config_file, clock=self.clock, metrics=self.metrics)
+
+    def test_token_bucket_refills_up_to_burst(self):
+        bucket = TokenBucket(Limit(2, 4), self.clock)
+        self.assertEqual(bucket.available(), 4)
+        bucket.take(4)
+        self.now = 1.0
+        self.assertEqual(bucket.available(), 2)
+        self.assertEqual(bucket.seconds_until(3), 0.5)
+        self.now = 10.0
+        self.assertEqual(bucket.available(), 4)
+
+    def test_unlimited(self):
+        rate_limiter = self.rate_limiter(Limit(0, 1), Limit(0, 1))
+        self.assertEqual(rate_limiter.acquire('domain.com', 1000), (1000, 0.0))
+
+    def test_global_and_domain_limits(self):
+        rate_limiter = self.rate_limiter(Limit(10, 10), Limit(1, 2),
+            {'Fast.com': Limit(5, 5)})
+        self.assertEqual(rate_limiter.acquire('slow.com', 3), (2, 1.0))
+        self.assertEqual(rate_limiter.acquire('fast.com', 6), (5, 0.2))
+        # the global bucket has 3 tokens left
+        self.assertEqual(rate_limiter.acquire('other.com', 2), (2, 0.0))
+        self.assertEqual(rate_limiter.acquire('another.com', 2), (1, 0.1))
+
+        self.assertEqual(self.metrics.get('mibs_rate_limit_granted_total', domain='*'), 5)
+        self.assertEqual(self.metrics.get('mibs_rate_limit_deferred_total', domain='fast.com'), 1)
+        self.assertEqual(self.metrics.get('mibs_rate_limit', domain='fast.com'), 5)
+
+    def test_configure_at_runtime(self):
+        rate_limiter = self.rate_limiter(Limit(0, 1), Limit(1, 1))
+        self.assertEqual(rate_limiter.acquire('domain.com', 2), (1, 1.0))
+        rate_limiter.configure(domain_limit=Limit(0, 1))
+        self.assertEqual(rate_limiter.acquire('domain.com', 2), (2, 0.0))
+
+    def test_reload_limits_from_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config_file = os.path.join(directory, 'limits.json')
+            with open(config_file, 'w', encoding='utf-8') as limits:
+                json.dump({'rate': 1, 'burst': 1}, limits)
+            rate_limiter = self.rate_limiter(Limit(0, 1), Limit(0, 1), config_file=config_file)
+            self.assertEqual(rate_limiter.acquire('domain.com', 2), (1, 1.0))
+
+            with open(config_file, 'w', encoding='utf-8') as limits:
+                json.dump({'domains': {'domain.com': {'rate': 3, 'burst': 3}}}, limits)
+            os.utime(config_file, (1, 1))
+            rate_limiter.reload_if_changed()
+            self.assertEqual(self.metrics.get('mibs_rate_limit', domain='domain.com'), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+'''
+    Retry policy unittest
+'''
+import random
+import unittest
+from datetime import datetime
+from services.retry_policy import RETRY_BASE_DELAY, RETRY_MAX_DELAY, next_attempt_at, \
+    retry_delay
+
+
+class TestRetryPolicy(unittest.TestCase):
+    '''
+    Retry policy unittest
+    '''
+    def test_delay_grows_exponentially_with_jitter(self):
+        rng = random.Random(371)
+        for attempt_count in range(1, 6):
+            backoff = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt_count - 1))
+            for _ in range(20):
+                delay = retry_delay(attempt_count, rng)
+                self.assertGreaterEqual(delay, backoff / 2)
+                self.assertLessEqual(delay, backoff)
+
+    def test_delay_is_capped(self):
+        self.assertLessEqual(retry_delay(1000), RETRY_MAX_DELAY)
+
+    def test_next_attempt_at(self):
+        now = datetime.utcnow()
+        self.assertGreaterEqual(next_attempt_at(1, now), now + RETRY_BASE_DELAY / 2)
+        self.assertLessEqual(next_attempt_at(1, now), now + RETRY_BASE_DELAY)
+
+if __name__ == '__main__':
+    unittest.main()
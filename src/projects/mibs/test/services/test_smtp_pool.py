@@ -0,0 +1,92 @@
+'''
+    SmtpConnectionPool unittest
+'''
+import smtplib
+import unittest
+from unittest.mock import MagicMock, patch
+from services.smtp_pool import SmtpConnectionPool
+
+class TestSmtpConnectionPool(unittest.TestCase):
+    '''
+    SmtpConnectionPool unittest
+    '''
+    def setUp(self):
+        self.servers = []
+        self.time = 1000.0
+        patcher = patch('services.smtp_pool.time.monotonic', side_effect=lambda: self.time)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def smtp_factory(self, *_args, **_kwargs):
+        server = MagicMock()
+        server.noop.return_value = (250, b'OK')
+        self.servers.append(server)
+        return server
+
+    def create_pool(self, **kwargs):
+        return SmtpConnectionPool('localhost', 1025, smtp_factory=self.smtp_factory, **kwargs)
+
+    def send(self, pool):
+        with pool.connection() as server:
+            server.sendmail('sender@email.com', 'recipient@email.com', 'message')
+
+    def test_connection_is_reused(self):
+        pool = self.create_pool()
+        self.send(pool)
+        self.send(pool)
+        self.assertEqual(len(self.servers), 1)
+        self.assertEqual(self.servers[0].sendmail.call_count, 2)
+        self.servers[0].noop.assert_not_called()
+
+    def test_max_messages_per_connection(self):
+        pool = self.create_pool(max_messages=2)
+        for _ in range(5):
+            self.send(pool)
+        self.assertEqual(len(self.servers), 3)
+        self.servers[0].quit.assert_called_once()
+        self.servers[1].quit.assert_called_once()
+
+    def test_idle_timeout(self):
+        pool = self.create_pool(idle_timeout=30.0)
+        self.send(pool)
+        self.time += 31.0
+        self.send(pool)
+        self.assertEqual(len(self.servers), 2)
+        self.servers[0].quit.assert_called_once()
+
+    def test_unhealthy_connection_is_replaced(self):
+        pool = self.create_pool(health_check_after=5.0)
+        self.send(pool)
+        self.servers[0].noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.time += 10.0
+        self.send(pool)
+        self.assertEqual(len(self.servers), 2)
+        self.servers[0].noop.assert_called_once()
+
+    def test_rejected_email_keeps_connection(self):
+        pool = self.create_pool()
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            with pool.connection():
+                raise smtplib.SMTPRecipientsRefused({'recipient@email.com': (550, b'No')})
+        self.send(pool)
+        self.assertEqual(len(self.servers), 1)
+
+    def test_broken_connection_is_discarded(self):
+        pool = self.create_pool(max_size=1)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            with pool.connection():
+                raise smtplib.SMTPServerDisconnected()
+        self.send(pool)
+        self.assertEqual(len(self.servers), 2)
+        self.servers[0].quit.assert_called_once()
+
+    def test_close(self):
+        pool = self.create_pool()
+        self.send(pool)
+        pool.close()
+        self.servers[0].quit.assert_called_once()
+        self.send(pool)
+        self.assertEqual(len(self.servers), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+    Transports unittest
+'''
+import mailbox
+import random
+import smtplib
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+from services.transports import MaildirTransport, MemoryTransport, SmtpTransport, Transport, \
+    create_transport
+
+SENDER = 'sender@email.com'
+CONTENT = 'Subject: MIBS\n\nHello, \nTest message'
+
+class TestTransports(unittest.TestCase):
+    '''
+    Transports unittest
+    '''
+    def test_transport_without_send_can_not_be_created(self):
+        class IncompleteTransport(Transport):
+            ''' A transport that forgot to implement send '''
+        with self.assertRaises(TypeError):
+            IncompleteTransport() # pylint: disable=abstract-class-instantiated
+
+    def test_smtp_transport_sends_over_the_pool(self):
+        server = MagicMock()
+        server.sendmail.return_value = {}
+        transport = SmtpTransport('localhost', 1025,
+            smtp_factory=MagicMock(return_value=server))
+        self.assertEqual(transport.send(SENDER, ['a@email.com'], CONTENT), {})
+        transport.send(SENDER, ['b@email.com'], CONTENT)
+
+        self.assertEqual(server.sendmail.call_count, 2)
+        transport.close()
+        server.quit.assert_called_once()
+
+    def test_maildir_transport_spools_with_envelope(self):
+        with tempfile.TemporaryDirectory() as path:
+            transport = MaildirTransport(path)
+            refused = transport.send(SENDER, ['a@email.com', 'b@email.com'], CONTENT)
+
+            self.assertEqual(refused, {})
+            emails = list(mailbox.Maildir(path, create=False))
+            self.assertEqual(len(emails), 1)
+            self.assertEqual(emails[0]['Subject'], 'MIBS')
+            self.assertEqual(emails[0]['X-Envelope-From'], SENDER)
+            self.assertEqual(emails[0]['X-Envelope-To'], 'a@email.com, b@email.com')
+
+    def test_memory_transport_keeps_sent_emails(self):
+        transport = MemoryTransport(max_kept=2)
+        for i in range(3):
+            transport.send(SENDER, [f'recipient{i}@email.com'], CONTENT)
+
+        self.assertEqual(transport.sent_count, 3)
+        self.assertEqual([email.recipients for email in transport.sent],
+            [['recipient1@email.com'], ['recipient2@email.com']])
+
+    def test_memory_transport_injects_failures(self):
+        transport = MemoryTransport(failure_rate=1.0)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            transport.send(SENDER, ['a@email.com'], CONTENT)
+
+        transport = MemoryTransport(refuse_rate=1.0)
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            transport.send(SENDER, ['a@email.com'], CONTENT)
+
+        transport = MemoryTransport(refuse_rate=0.5, rng=random.Random(1))
+        recipients = [f'recipient{i}@email.com' for i in range(20)]
+        refused = transport.send(SENDER, recipients, CONTENT)
+        self.assertGreater(len(refused), 0)
+        self.assertEqual(set(refused) | set(transport.sent[0].recipients), set(recipients))
+        self.assertEqual({code for code, _ in refused.values()}, {451})
+        self.assertEqual(transport.sent_count, 1)
+
+    def test_create_transport(self):
+        self.assertIsInstance(create_transport('memory'), MemoryTransport)
+        self.assertIsInstance(create_transport('smtp'), SmtpTransport)
+        with self.assertRaises(ValueError):
+            create_transport('pigeon')